@@ -0,0 +1,127 @@
+# backup.py
+import asyncio
+import gzip
+import os
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+from datetime import datetime
+
+PART_SIZE = 49 * 1024 * 1024
+COPY_CHUNK = 1024 * 1024
+SNAPSHOT_PREFIX = "bot-"
+IDENTIFIER = re.compile(r"[A-Za-z_][A-Za-z0-9_]*")
+
+class PartWriter:
+    def __init__(self, base: str, part_size: int):
+        self.base = base
+        self.part_size = part_size
+        self.paths = []
+        self._file = None
+        self._written = 0
+
+    def write(self, data: bytes) -> int:
+        view = memoryview(data)
+        while view:
+            if self._file is None or self._written >= self.part_size:
+                self._next()
+            chunk = view[:self.part_size - self._written]
+            self._file.write(chunk)
+            self._written += len(chunk)
+            view = view[len(chunk):]
+        return len(data)
+
+    def flush(self):
+        if self._file is not None:
+            self._file.flush()
+
+    def _next(self):
+        if self._file is not None:
+            self._file.close()
+        self.paths.append(f"{self.base}.{len(self.paths) + 1:03d}")
+        self._file = open(self.paths[-1], "wb")
+        self._written = 0
+
+    def close(self) -> list:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if len(self.paths) == 1:
+            os.replace(self.paths[0], self.base)
+            self.paths = [self.base]
+        return self.paths
+
+def _copy(db_path: str, target: str):
+    source = sqlite3.connect(f"file:{db_path}?mode=ro", uri=True)
+    destination = sqlite3.connect(target)
+    try:
+        source.execute("PRAGMA busy_timeout=5000")
+        source.backup(destination, pages=-1)
+    finally:
+        destination.close()
+        source.close()
+
+def _exclude(target: str, exclude: tuple):
+    db = sqlite3.connect(target)
+    try:
+        for name in exclude:
+            table, _, column = name.partition(".")
+            if not IDENTIFIER.fullmatch(table) or column and not IDENTIFIER.fullmatch(column):
+                raise ValueError(f"Invalid exclusion: {name!r}")
+            if column:
+                db.execute(f"UPDATE {table} SET {column} = NULL")
+            else:
+                db.execute(f"DELETE FROM {table}")
+        db.commit()
+        db.execute("VACUUM")
+    finally:
+        db.close()
+
+def _compress(source: str, base: str, part_size: int) -> list:
+    parts = PartWriter(base, part_size)
+    try:
+        with open(source, "rb") as raw, gzip.GzipFile(filename=os.path.basename(base)[:-3], mode="wb", fileobj=parts) as gz:
+            shutil.copyfileobj(raw, gz, COPY_CHUNK)
+    finally:
+        paths = parts.close()
+    return paths
+
+def snapshot(db_path: str, directory: str, exclude: tuple = (), part_size: int = PART_SIZE) -> list:
+    os.makedirs(directory, exist_ok=True)
+    name = f"{SNAPSHOT_PREFIX}{datetime.utcnow():%Y%m%d-%H%M%S-%f}.db.gz"
+    with tempfile.TemporaryDirectory(dir=directory) as scratch:
+        copy = os.path.join(scratch, "snapshot.db")
+        _copy(db_path, copy)
+        if exclude:
+            _exclude(copy, exclude)
+        paths = []
+        for part in _compress(copy, os.path.join(scratch, name), part_size):
+            paths.append(os.path.join(directory, os.path.basename(part)))
+            os.replace(part, paths[-1])
+        return paths
+
+async def create_snapshot(db_path: str, directory: str, exclude: tuple = (), part_size: int = PART_SIZE) -> list:
+    return await asyncio.to_thread(snapshot, db_path, directory, exclude, part_size)
+
+def prune_snapshots(directory: str, keep: int) -> int:
+    snapshots = {}
+    for name in os.listdir(directory):
+        if name.startswith(SNAPSHOT_PREFIX) and ".db.gz" in name:
+            snapshots.setdefault(name.split(".db.gz")[0], []).append(name)
+    removed = 0
+    for stamp in sorted(snapshots)[:-keep or None]:
+        for name in snapshots[stamp]:
+            os.remove(os.path.join(directory, name))
+            removed += 1
+    return removed
+
+def snapshot_age(directory: str):
+    if not os.path.isdir(directory):
+        return None
+    mtimes = [
+        os.path.getmtime(os.path.join(directory, name)) for name in os.listdir(directory)
+        if name.startswith(SNAPSHOT_PREFIX) and ".db.gz" in name
+    ]
+    return time.time() - max(mtimes) if mtimes else None
@@ -0,0 +1,281 @@
+# bench.py
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import Counter as Tally
+
+from aiohttp import web
+
+BENCH_TOKEN = "123456:bench"
+BENCH_CHAT_ID = -1001000000000
+BENCH_USER_ID = 1000000000
+BENCH_ENV = {
+    "TOKEN": BENCH_TOKEN,
+    "WEBHOOK_URL": "http://127.0.0.1",
+    "TRACE_FILE": "",
+    "RATE_USER_PER_MINUTE": "1000000",
+    "RATE_USER_BURST": "1000000",
+    "RATE_CHAT_PER_MINUTE": "1000000",
+    "RATE_CHAT_BURST": "1000000",
+}
+COMPARED = ("updates_per_s", "p50_ms", "p95_ms", "p99_ms", "sqlite_rows_per_s", "telegram_calls_per_update")
+
+def fake_message(chat_id: int, message_id: int) -> dict:
+    return {"message_id": message_id, "date": int(time.time()), "chat": {"id": chat_id, "type": "supergroup", "title": "bench"}}
+
+def run_fakes(config: dict, ports):
+    random.seed(config["seed"])
+    calls = Tally()
+    upstream = Tally()
+    message_ids = iter(range(1, 1 << 62))
+    padding = "x" * config["payload_bytes"]
+
+    async def telegram(request):
+        method = request.match_info["method"]
+        calls[method] += 1
+        data = await request.post()
+        if config["telegram_latency_ms"]:
+            await asyncio.sleep(config["telegram_latency_ms"] / 1000)
+        if random.random() < config["telegram_error_rate"]:
+            calls["retry_after"] += 1
+            return web.json_response({
+                "ok": False, "error_code": 429, "description": "Too Many Requests: retry after 1",
+                "parameters": {"retry_after": 1}
+            })
+        if method in ("sendMessage", "sendDocument"):
+            result = fake_message(int(data.get("chat_id", 0)), next(message_ids))
+        elif method == "getChatMember":
+            result = {"status": "member", "user": {"id": int(data.get("user_id", 0)), "is_bot": False, "first_name": "bench"}}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    async def command(request):
+        upstream["requests"] += 1
+        delay = config["latency_ms"] + random.uniform(-config["jitter_ms"], config["jitter_ms"])
+        await asyncio.sleep(max(delay, 0) / 1000)
+        if random.random() < config["error_rate"]:
+            upstream["errors"] += 1
+            return web.Response(status=500)
+        return web.json_response({"query": request.query.get("q"), "command": request.match_info["command"], "data": padding})
+
+    async def stats(request):
+        return web.json_response({"telegram": dict(calls), "upstream": dict(upstream)})
+
+    async def serve():
+        app = web.Application()
+        app.add_routes([
+            web.post("/bot{token}/{method}", telegram),
+            web.get("/upstream/{command}", command),
+            web.get("/stats", stats),
+        ])
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        ports.put(runner.addresses[0][1])
+        await asyncio.Event().wait()
+
+    asyncio.run(serve())
+
+def synthetic_updates(args, commands: list) -> list:
+    rng = random.Random(args.seed)
+    queries = [str(rng.randrange(10 ** 9, 10 ** 10)) for _ in range(args.queries)]
+    updates = []
+    for update_id in range(1, args.updates + 1):
+        cmd = rng.choice(commands)
+        message = fake_message(BENCH_CHAT_ID - rng.randrange(args.chats), update_id)
+        message["from"] = {"id": BENCH_USER_ID + rng.randrange(args.users), "is_bot": False, "first_name": "bench"}
+        message["text"] = f"/{cmd} {rng.choice(queries)}"
+        message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(cmd) + 1}]
+        updates.append({"update_id": update_id, "message": message})
+    return updates
+
+def percentile(samples: list, q: float) -> float:
+    if not samples:
+        return 0.0
+    return samples[min(len(samples) - 1, int(q * len(samples)))]
+
+def commit_id() -> str:
+    root = os.path.dirname(os.path.abspath(__file__))
+    try:
+        sha = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=root, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=root, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+    return f"{sha}-dirty" if dirty else sha
+
+async def fetch_stats(session, base: str) -> dict:
+    async with session.get(f"{base}/stats") as response:
+        return await response.json()
+
+async def replay(session, url: str, updates: list, concurrency: int, rate: float) -> Tally:
+    outcomes = Tally()
+    pending = iter(updates)
+    started = time.perf_counter()
+    sent = 0
+
+    async def sender():
+        nonlocal sent
+        for update in pending:
+            if rate:
+                sent += 1
+                await asyncio.sleep(max(started + sent / rate - time.perf_counter(), 0))
+            async with session.post(url, json=update) as response:
+                outcomes["accepted" if response.status == 200 else f"http_{response.status}"] += 1
+
+    await asyncio.gather(*(sender() for _ in range(concurrency)))
+    return outcomes
+
+async def run(args) -> dict:
+    import aiohttp
+    from aiogram.client.telegram import TelegramAPIServer
+
+    context = multiprocessing.get_context("spawn")
+    ports = context.Queue()
+    fakes = context.Process(target=run_fakes, args=(vars(args), ports), name="bench-fakes", daemon=True)
+    fakes.start()
+    base = f"http://127.0.0.1:{await asyncio.to_thread(ports.get, True, 30)}"
+
+    os.environ.update({key: value for key, value in BENCH_ENV.items() if key not in os.environ})
+    import database
+    import main
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("update_queue").setLevel(logging.CRITICAL)
+
+    scratch = tempfile.TemporaryDirectory(prefix="bench-")
+    database.DB_PATH = main.DB_PATH = os.path.join(scratch.name, "bench.db")
+    main.bot.session.api = TelegramAPIServer.from_base(base)
+    for cmd, config in main.COMMANDS.items():
+        config["url"] = f"{base}/upstream/{cmd}?q={{query}}"
+    commands = args.commands.split(",") if args.commands else list(main.COMMANDS)
+    unknown = [cmd for cmd in commands if cmd not in main.COMMANDS]
+    if unknown:
+        raise SystemExit(f"Unknown commands: {', '.join(unknown)}")
+    updates = synthetic_updates(args, commands)
+
+    samples = []
+    observe = main.COMMAND_LATENCY.observe
+    def record(value, *labels):
+        samples.append(value)
+        observe(value, *labels)
+    main.COMMAND_LATENCY.observe = record
+
+    runner = web.AppRunner(main.app, access_log=None)
+    try:
+        await runner.setup()
+        site = web.TCPSite(runner, "127.0.0.1", 0)
+        await site.start()
+        webhook = f"http://127.0.0.1:{runner.addresses[0][1]}{main.WEBHOOK_PATH}"
+        connector = aiohttp.TCPConnector(limit=args.concurrency)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            rows_before = database._writer.total_changes
+            before = await fetch_stats(session, base)
+            started = time.perf_counter()
+            outcomes = await replay(session, webhook, updates, args.concurrency, args.rate)
+            deadline = time.monotonic() + args.timeout
+            while len(samples) < outcomes["accepted"] and time.monotonic() < deadline:
+                await asyncio.sleep(0.01)
+            elapsed = time.perf_counter() - started
+            failed = main.update_queue.stats()["failed"]
+            await database._buffer.flush()
+            rows = database._writer.total_changes - rows_before
+            await main.log_shipper.close()
+            after = await fetch_stats(session, base)
+    finally:
+        await runner.cleanup()
+        fakes.terminate()
+        scratch.cleanup()
+
+    calls = Tally(after["telegram"])
+    calls.subtract(before["telegram"])
+    calls.pop("deleteWebhook", None)
+    retries = calls.pop("retry_after", 0)
+    handled = len(samples)
+    samples.sort()
+    return {
+        "commit": commit_id(),
+        "python": platform.python_version(),
+        "config": {key: value for key, value in vars(args).items() if key != "output"},
+        "sent": len(updates),
+        "outcomes": dict(outcomes),
+        "handled": handled,
+        "failed": failed,
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_s": round(handled / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(samples, 0.50) * 1000, 2),
+        "p95_ms": round(percentile(samples, 0.95) * 1000, 2),
+        "p99_ms": round(percentile(samples, 0.99) * 1000, 2),
+        "max_ms": round(samples[-1] * 1000, 2) if samples else 0.0,
+        "sqlite_rows": rows,
+        "sqlite_rows_per_s": round(rows / elapsed, 1) if elapsed else 0.0,
+        "telegram_calls": {method: count for method, count in sorted(calls.items()) if count},
+        "telegram_retry_after": retries,
+        "telegram_calls_per_update": round(sum(calls.values()) / handled, 2) if handled else 0.0,
+        "upstream": {key: after["upstream"].get(key, 0) - before["upstream"].get(key, 0) for key in ("requests", "errors")},
+    }
+
+def previous_result(path: str, config: dict):
+    if not path or not os.path.exists(path):
+        return None
+    match = None
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                result = json.loads(line)
+                if result.get("config") == config:
+                    match = result
+    return match
+
+def report(result: dict, previous: dict = None):
+    print(f"commit {result['commit']}  python {result['python']}")
+    print(f"sent {result['sent']}  outcomes {result['outcomes']}  handled {result['handled']} (failed {result['failed']}) in {result['elapsed_s']}s")
+    for key in COMPARED:
+        line = f"  {key:<26} {result[key]:>10}"
+        if previous and previous.get(key):
+            line += f"  ({(result[key] - previous[key]) / previous[key] * 100:+.1f}% vs {previous['commit']})"
+        print(line)
+    print(f"  {'max_ms':<26} {result['max_ms']:>10}")
+    print(f"  telegram calls {result['telegram_calls']}  retry_after {result['telegram_retry_after']}")
+    print(f"  upstream {result['upstream']}  sqlite rows {result['sqlite_rows']}")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Replay synthetic updates through the webhook against fake Telegram and upstream servers.")
+    parser.add_argument("--updates", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=40, help="Concurrent webhook deliveries")
+    parser.add_argument("--rate", type=float, default=0, help="Target updates per second, 0 for as fast as possible")
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--chats", type=int, default=20)
+    parser.add_argument("--queries", type=int, default=1000, help="Distinct query values")
+    parser.add_argument("--commands", default="", help="Comma-separated commands, default all")
+    parser.add_argument("--latency-ms", type=float, default=50, help="Mean upstream latency")
+    parser.add_argument("--jitter-ms", type=float, default=20)
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Fraction of upstream requests answered with 500")
+    parser.add_argument("--payload-bytes", type=int, default=500)
+    parser.add_argument("--telegram-latency-ms", type=float, default=5)
+    parser.add_argument("--telegram-error-rate", type=float, default=0.0, help="Fraction of Bot API calls answered with 429")
+    parser.add_argument("--timeout", type=float, default=120, help="Seconds to wait for queued updates after the replay")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="Append the JSON result to this file and compare with the last matching run")
+    return parser.parse_args(argv)
+
+def main_cli(argv=None):
+    args = parse_args(argv)
+    result = asyncio.run(run(args))
+    report(result, previous_result(args.output, result["config"]))
+    if args.output:
+        with open(args.output, "a") as f:
+            f.write(json.dumps(result) + "\n")
+    return 0 if result["handled"] == result["outcomes"].get("accepted", 0) else 1
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,221 @@
+# broadcast.py
+import asyncio
+import logging
+import time
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramForbiddenError, TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+)
+
+from database import (
+    create_broadcast_job, finish_broadcast_job, get_pending_recipients, get_unfinished_broadcast_jobs,
+    save_broadcast_progress
+)
+from ratelimit import TokenBucket
+
+PER_CHAT_INTERVAL = 1.0
+CHECKPOINT_INTERVAL = 2.0
+MAX_FLOOD_WAITS = 10
+KEEP_FINISHED_JOBS = 20
+KIND_LABELS = {"broadcast": "Broadcast", "bulkdm": "Bulk DM"}
+
+logger = logging.getLogger(__name__)
+
+class BroadcastJob:
+    def __init__(self, job_id: int, kind: str, from_chat_id: int, message_id: int, user_ids: list):
+        self.id = job_id
+        self.kind = kind
+        self.from_chat_id = from_chat_id
+        self.message_id = message_id
+        self.user_ids = user_ids
+        self.total = len(user_ids)
+        self.sent = 0
+        self.blocked = 0
+        self.failed = 0
+        self.retried = 0
+        self.results = []
+        self.status = "running"
+        self.cancel_requested = False
+        self.started_at = time.monotonic()
+        self.finished_at = None
+        self.status_chat_id = None
+        self.status_message_id = None
+        self.task = None
+        self.delayed = set()
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.blocked + self.failed
+
+    def progress_text(self) -> str:
+        elapsed = (self.finished_at or time.monotonic()) - self.started_at
+        return (
+            f"{KIND_LABELS.get(self.kind, self.kind)} #{self.id} {self.status}: {self.done}/{self.total}\n"
+            f"Sent: {self.sent}, blocked: {self.blocked}, failed: {self.failed}, retried: {self.retried}\n"
+            f"Elapsed: {elapsed:.0f}s"
+        )
+
+class BroadcastEngine:
+    def __init__(self, bot: Bot, rate: float, workers: int, max_attempts: int = 3, progress_interval: float = 10):
+        self.bot = bot
+        self.bucket = TokenBucket(rate, rate)
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.progress_interval = progress_interval
+        self.jobs = {}
+        self._resume_at = 0.0
+
+    async def submit(self, kind: str, from_chat_id: int, message_id: int, user_ids: list,
+                     status_chat_id: int = None, status_message_id: int = None) -> int:
+        user_ids = list(dict.fromkeys(user_ids))
+        job_id = await create_broadcast_job(
+            kind, from_chat_id, message_id, user_ids, status_chat_id, status_message_id
+        )
+        job = BroadcastJob(job_id, kind, from_chat_id, message_id, user_ids)
+        job.status_chat_id = status_chat_id
+        job.status_message_id = status_message_id
+        self._start(job)
+        return job.id
+
+    async def resume(self):
+        for row in await get_unfinished_broadcast_jobs():
+            job_id, kind, from_chat_id, message_id, status_chat_id, status_message_id, total, sent, blocked, failed = row
+            job = BroadcastJob(job_id, kind, from_chat_id, message_id, await get_pending_recipients(job_id))
+            job.total, job.sent, job.blocked, job.failed = total, sent, blocked, failed
+            job.status_chat_id = status_chat_id
+            job.status_message_id = status_message_id
+            logger.info("Resuming %s #%s with %s pending recipients", kind, job_id, len(job.user_ids))
+            self._start(job)
+
+    def _start(self, job: BroadcastJob):
+        self.jobs[job.id] = job
+        job.task = asyncio.create_task(self._run(job))
+
+    async def progress(self) -> list:
+        return [job.progress_text() for job in self.jobs.values()]
+
+    async def cancel(self, job_id: int) -> bool:
+        job = self.jobs.get(job_id)
+        if job is None or job.status != "running":
+            return False
+        job.cancel_requested = True
+        job.task.cancel()
+        return True
+
+    async def close(self):
+        tasks = [job.task for job in self.jobs.values() if job.status == "running"]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, job: BroadcastJob):
+        queue = asyncio.Queue()
+        for user_id in job.user_ids:
+            queue.put_nowait((user_id, 1, 0))
+        workers = [asyncio.create_task(self._worker(job, queue)) for _ in range(self.workers)]
+        monitor = asyncio.create_task(self._monitor(job))
+        try:
+            await queue.join()
+            while job.delayed:
+                await asyncio.gather(*job.delayed)
+                await queue.join()
+            job.status = "done"
+        except asyncio.CancelledError:
+            job.status = "cancelled" if job.cancel_requested else "interrupted"
+        finally:
+            job.finished_at = time.monotonic()
+            tasks = workers + [monitor] + list(job.delayed)
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            self._prune()
+        await self._checkpoint(job)
+        if job.status != "interrupted":
+            await finish_broadcast_job(job.id, job.status)
+        logger.info("%s #%s %s: %s/%s sent", job.kind, job.id, job.status, job.sent, job.total)
+        await self._report(job)
+
+    async def _worker(self, job: BroadcastJob, queue: asyncio.Queue):
+        while True:
+            user_id, attempt, flood_waits = await queue.get()
+            try:
+                await self._send(job, user_id, attempt, flood_waits, queue)
+            finally:
+                queue.task_done()
+
+    async def _send(self, job: BroadcastJob, user_id: int, attempt: int, flood_waits: int, queue: asyncio.Queue):
+        delay = self._resume_at - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        await self.bucket.take()
+        try:
+            await self.bot.copy_message(user_id, job.from_chat_id, job.message_id)
+        except TelegramRetryAfter as e:
+            self._resume_at = max(self._resume_at, time.monotonic() + e.retry_after)
+            if flood_waits + 1 >= MAX_FLOOD_WAITS:
+                job.failed += 1
+                job.results.append((user_id, "failed"))
+                return
+            job.retried += 1
+            queue.put_nowait((user_id, attempt, flood_waits + 1))
+        except TelegramForbiddenError:
+            job.blocked += 1
+            job.results.append((user_id, "blocked"))
+        except (TelegramNetworkError, TelegramServerError):
+            self._retry(job, user_id, attempt, flood_waits, queue)
+        except Exception:
+            job.failed += 1
+            job.results.append((user_id, "failed"))
+        else:
+            job.sent += 1
+            job.results.append((user_id, "sent"))
+
+    def _retry(self, job: BroadcastJob, user_id: int, attempt: int, flood_waits: int, queue: asyncio.Queue):
+        if attempt >= self.max_attempts:
+            job.failed += 1
+            job.results.append((user_id, "failed"))
+            return
+        job.retried += 1
+        task = asyncio.create_task(self._requeue_later(queue, (user_id, attempt + 1, flood_waits)))
+        job.delayed.add(task)
+        task.add_done_callback(job.delayed.discard)
+
+    async def _requeue_later(self, queue: asyncio.Queue, item: tuple):
+        await asyncio.sleep(PER_CHAT_INTERVAL)
+        queue.put_nowait(item)
+
+    async def _monitor(self, job: BroadcastJob):
+        reported_at = 0.0
+        while True:
+            if time.monotonic() - reported_at >= self.progress_interval:
+                await self._report(job)
+                reported_at = time.monotonic()
+            await asyncio.sleep(CHECKPOINT_INTERVAL)
+            try:
+                await self._checkpoint(job)
+            except Exception:
+                logger.exception("Failed to checkpoint %s #%s", job.kind, job.id)
+
+    async def _checkpoint(self, job: BroadcastJob):
+        results, job.results = job.results, []
+        try:
+            await save_broadcast_progress(job.id, results, job.sent, job.blocked, job.failed)
+        except BaseException:
+            job.results[:0] = results
+            raise
+
+    async def _report(self, job: BroadcastJob):
+        if job.status_message_id is None:
+            return
+        try:
+            await self.bot.edit_message_text(
+                job.progress_text(), chat_id=job.status_chat_id, message_id=job.status_message_id
+            )
+        except Exception:
+            pass
+
+    def _prune(self):
+        finished = [job_id for job_id, job in self.jobs.items() if job.status != "running"]
+        for job_id in finished[:-KEEP_FINISHED_JOBS]:
+            del self.jobs[job_id]
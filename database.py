@@ -1,175 +1,709 @@
 # database.py
-import aiosqlite
+import asyncio
+import logging
+import re
+import time
+from contextlib import asynccontextmanager
 from datetime import datetime, timedelta
 
+import aiosqlite
+
+from metrics import Histogram, timed
+
 DB_PATH = "bot.db"
+READER_POOL_SIZE = 4
+PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",
+    "PRAGMA mmap_size=268435456",
+)
+
+WRITE_BATCH_SIZE = 200
+WRITE_FLUSH_INTERVAL = 0.25
+MAX_USER_ID = 2 ** 63 - 1
+MAX_USER_ID_DIGITS = len(str(MAX_USER_ID))
+DATE_PREFIX = re.compile(r"\d{4}(-\d{2}(-\d{2})?)?")
+
+_writer = None
+_write_lock = None
+_readers = None
+_buffer = None
+_admins = set()
+_banned = set()
+_acl_listeners = []
+
+DB_LATENCY = Histogram("bot_db_query_seconds", "SQLite query latency per database function", ("function",))
+
+logger = logging.getLogger(__name__)
+
+async def _connect(read_only: bool = False):
+    db = await aiosqlite.connect(DB_PATH)
+    for pragma in PRAGMAS:
+        await db.execute(pragma)
+    if read_only:
+        await db.execute("PRAGMA query_only=ON")
+    return db
+
+@asynccontextmanager
+async def _read():
+    db = await _readers.get()
+    try:
+        yield db
+    finally:
+        _readers.put_nowait(db)
+
+@asynccontextmanager
+async def _write():
+    async with _write_lock:
+        try:
+            yield _writer
+            await _writer.commit()
+        except BaseException:
+            await _writer.rollback()
+            raise
+
+class WriteBuffer:
+    def __init__(self, max_records: int, interval: float):
+        self.max_records = max_records
+        self.interval = interval
+        self._users = {}
+        self._lookups = []
+        self._stats = {}
+        self._pending = 0
+        self._full = asyncio.Event()
+        self._task = None
+        self._flushing = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def update_user(self, user_id: int, last_seen: str, increment: int):
+        prev_seen, prev_increment = self._users.get(user_id, (last_seen, 0))
+        self._users[user_id] = (max(prev_seen, last_seen), prev_increment + increment)
+        self._added()
+
+    def add_lookup(self, user_id: int, command: str, query: str, result: str, timestamp: str):
+        self._lookups.append((user_id, command, query, result, timestamp))
+        self._added()
+
+    def increment_daily_stat(self, date: str, command: str):
+        self._stats[(date, command)] = self._stats.get((date, command), 0) + 1
+        self._added()
+
+    def _added(self):
+        self._pending += 1
+        if self._pending >= self.max_records:
+            self._full.set()
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._full.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._full.clear()
+            self._flushing = asyncio.ensure_future(self.flush())
+            try:
+                await asyncio.shield(self._flushing)
+            except Exception:
+                logger.exception("Failed to flush buffered writes")
+
+    async def flush(self):
+        if self._pending:
+            await self._flush()
+
+    @timed(DB_LATENCY, "flush_writes")
+    async def _flush(self):
+        users, lookups, stats = self._users, self._lookups, self._stats
+        self._users, self._lookups, self._stats, self._pending = {}, [], {}, 0
+        command_counts = {}
+        for (date, command), count in stats.items():
+            command_counts[command] = command_counts.get(command, 0) + count
+        try:
+            async with _write() as db:
+                await db.executemany(
+                    "UPDATE users SET last_seen = ?, total_lookups = total_lookups + ? WHERE user_id = ?",
+                    [(last_seen, increment, user_id) for user_id, (last_seen, increment) in users.items()]
+                )
+                await db.executemany(
+                    "INSERT INTO lookups (user_id, command, query, result, timestamp) VALUES (?, ?, ?, ?, ?)",
+                    lookups
+                )
+                await db.executemany(
+                    "INSERT INTO daily_stats (date, command, count) VALUES (?, ?, ?) "
+                    "ON CONFLICT (date, command) DO UPDATE SET count = count + excluded.count",
+                    [(date, command, count) for (date, command), count in stats.items()]
+                )
+                await db.executemany(BUMP_COMMAND_COUNT, command_counts.items())
+                if lookups:
+                    await db.execute(BUMP_COUNTER, (len(lookups), "lookups"))
+        except BaseException:
+            self._requeue(users, lookups, stats)
+            raise
+
+    def _requeue(self, users: dict, lookups: list, stats: dict):
+        for user_id, (last_seen, increment) in users.items():
+            prev_seen, prev_increment = self._users.get(user_id, (last_seen, 0))
+            self._users[user_id] = (max(prev_seen, last_seen), prev_increment + increment)
+        self._lookups[:0] = lookups
+        for key, count in stats.items():
+            self._stats[key] = self._stats.get(key, 0) + count
+        self._pending += len(users) + len(lookups) + len(stats)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._flushing is not None:
+            await asyncio.gather(self._flushing, return_exceptions=True)
+            self._flushing = None
+        await self.flush()
+
+BUMP_COUNTER = "UPDATE counters SET value = value + ? WHERE name = ?"
+BUMP_COMMAND_COUNT = (
+    "INSERT INTO command_counts (command, count) VALUES (?, ?) "
+    "ON CONFLICT (command) DO UPDATE SET count = count + excluded.count"
+)
+REBUILD_COUNTERS = (
+    "DELETE FROM counters",
+    "INSERT INTO counters (name, value) SELECT 'users', COUNT(*) FROM users",
+    "INSERT INTO counters (name, value) SELECT 'lookups', COUNT(*) FROM lookups",
+    "DELETE FROM command_counts",
+    "INSERT INTO command_counts (command, count) SELECT command, SUM(count) FROM daily_stats GROUP BY command",
+)
+
+MIGRATIONS = [
+    (
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            user_id INTEGER PRIMARY KEY,
+            first_seen TEXT,
+            last_seen TEXT,
+            total_lookups INTEGER
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS admins (
+            user_id INTEGER PRIMARY KEY
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS banned (
+            user_id INTEGER PRIMARY KEY
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS lookups (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            command TEXT,
+            query TEXT,
+            result TEXT,
+            timestamp TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            date TEXT,
+            command TEXT,
+            count INTEGER,
+            PRIMARY KEY (date, command)
+        )
+        """,
+    ),
+    (
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT,
+            from_chat_id INTEGER,
+            message_id INTEGER,
+            status_chat_id INTEGER,
+            status_message_id INTEGER,
+            status TEXT,
+            total INTEGER,
+            sent INTEGER,
+            blocked INTEGER,
+            failed INTEGER,
+            created_at TEXT,
+            finished_at TEXT
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS broadcast_recipients (
+            job_id INTEGER,
+            user_id INTEGER,
+            status TEXT,
+            PRIMARY KEY (job_id, user_id)
+        ) WITHOUT ROWID
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS blocked_users (
+            user_id INTEGER PRIMARY KEY,
+            blocked_at TEXT
+        )
+        """,
+    ),
+    ("CREATE INDEX IF NOT EXISTS idx_lookups_user_timestamp ON lookups (user_id, timestamp)",),
+    ("CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users (last_seen)",),
+    ("CREATE INDEX IF NOT EXISTS idx_users_total_lookups ON users (total_lookups)",),
+    (
+        "CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER) WITHOUT ROWID",
+        "CREATE TABLE IF NOT EXISTS command_counts (command TEXT PRIMARY KEY, count INTEGER) WITHOUT ROWID",
+    ) + REBUILD_COUNTERS,
+    # 7 used to switch auto_vacuum with a full VACUUM at startup; see enable_incremental_vacuum()
+    (),
+    ("CREATE INDEX IF NOT EXISTS idx_users_first_seen ON users (first_seen)",),
+    (
+        "CREATE TABLE IF NOT EXISTS fsm_states (key TEXT PRIMARY KEY, state TEXT, data TEXT, updated_at REAL) WITHOUT ROWID",
+        "CREATE INDEX IF NOT EXISTS idx_fsm_states_updated_at ON fsm_states (updated_at)",
+    ),
+]
+
+async def migrate():
+    async with _write_lock:
+        version = (await _writer.execute_fetchall("PRAGMA user_version"))[0][0]
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        started = time.monotonic()
+        async with _write() as db:
+            if callable(migration):
+                await migration(db)
+            else:
+                await db.execute("BEGIN IMMEDIATE")
+                for statement in migration:
+                    await db.execute(statement)
+            await db.execute(f"PRAGMA user_version = {number}")
+        logger.info("Applied schema migration %s in %.2fs", number, time.monotonic() - started)
 
 async def init_db():
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                first_seen TEXT,
-                last_seen TEXT,
-                total_lookups INTEGER
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS admins (
-                user_id INTEGER PRIMARY KEY
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS banned (
-                user_id INTEGER PRIMARY KEY
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS lookups (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                command TEXT,
-                query TEXT,
-                result TEXT,
-                timestamp TEXT
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS daily_stats (
-                date TEXT,
-                command TEXT,
-                count INTEGER,
-                PRIMARY KEY (date, command)
-            )
-        """)
-        await db.commit()
+    global _writer, _write_lock, _readers, _buffer
+    _writer = await _connect()
+    await _writer.execute("PRAGMA journal_mode=WAL")
+    _write_lock = asyncio.Lock()
+    await migrate()
+    _readers = asyncio.Queue()
+    for _ in range(READER_POOL_SIZE):
+        _readers.put_nowait(await _connect(read_only=True))
+    await load_acl()
+    _buffer = WriteBuffer(WRITE_BATCH_SIZE, WRITE_FLUSH_INTERVAL)
+    _buffer.start()
+
+def add_acl_listener(callback):
+    _acl_listeners.append(callback)
 
+def _acl_changed(changed: int):
+    if changed:
+        for callback in _acl_listeners:
+            callback()
+
+@timed(DB_LATENCY)
+async def load_acl():
+    global _admins, _banned
+    async with _read() as db:
+        _admins = {row[0] for row in await db.execute_fetchall("SELECT user_id FROM admins")}
+        _banned = {row[0] for row in await db.execute_fetchall("SELECT user_id FROM banned")}
+
+async def close_db():
+    global _writer, _readers, _buffer
+    if _buffer is not None:
+        await _buffer.close()
+        _buffer = None
+    if _readers is not None:
+        while not _readers.empty():
+            await _readers.get_nowait().close()
+        _readers = None
+    if _writer is not None:
+        await _writer.close()
+        _writer = None
+
+@timed(DB_LATENCY)
 async def add_user(user_id: int, first_seen: str, last_seen: str, total_lookups: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute(
+    async with _write() as db:
+        async with db.execute(
             "INSERT OR IGNORE INTO users (user_id, first_seen, last_seen, total_lookups) VALUES (?, ?, ?, ?)",
             (user_id, first_seen, last_seen, total_lookups)
-        )
-        await db.commit()
+        ) as cursor:
+            added = cursor.rowcount
+        if added:
+            await db.execute(BUMP_COUNTER, (added, "users"))
 
+@timed(DB_LATENCY)
 async def update_user(user_id: int, last_seen: str, increment: int):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _write() as db:
         await db.execute(
             "UPDATE users SET last_seen = ?, total_lookups = total_lookups + ? WHERE user_id = ?",
             (last_seen, increment, user_id)
         )
-        await db.commit()
 
+def queue_user_update(user_id: int, last_seen: str, increment: int):
+    _buffer.update_user(user_id, last_seen, increment)
+
+@timed(DB_LATENCY)
 async def get_user(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,))
-        return await cursor.fetchone()
+    async with _read() as db:
+        async with db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) as cursor:
+            return await cursor.fetchone()
 
+@timed(DB_LATENCY)
 async def get_all_users():
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT user_id FROM users")
-        return [row[0] for row in await cursor.fetchall()]
+    async with _read() as db:
+        return [row[0] for row in await db.execute_fetchall("SELECT user_id FROM users")]
 
+@timed(DB_LATENCY)
 async def get_recent_users(limit: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT user_id, last_seen FROM users ORDER BY last_seen DESC LIMIT ?", (limit,))
-        return await cursor.fetchall()
+    async with _read() as db:
+        return await db.execute_fetchall("SELECT user_id, last_seen FROM users ORDER BY last_seen DESC LIMIT ?", (limit,))
 
-async def get_user_lookups(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT * FROM lookups WHERE user_id = ? ORDER BY timestamp DESC", (user_id,))
-        return await cursor.fetchall()
+@timed(DB_LATENCY)
+async def get_user_lookups(user_id: int, before: tuple = None, limit: int = -1):
+    async with _read() as db:
+        if before is None:
+            return await db.execute_fetchall(
+                "SELECT * FROM lookups WHERE user_id = ? ORDER BY timestamp DESC, id DESC LIMIT ?", (user_id, limit)
+            )
+        return await db.execute_fetchall(
+            "SELECT * FROM lookups WHERE user_id = ? AND (timestamp, id) < (?, ?) "
+            "ORDER BY timestamp DESC, id DESC LIMIT ?",
+            (user_id, *before, limit)
+        )
 
+@timed(DB_LATENCY)
 async def get_leaderboard(limit: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT user_id, total_lookups FROM users ORDER BY total_lookups DESC LIMIT ?", (limit,))
-        return await cursor.fetchall()
+    async with _read() as db:
+        return await db.execute_fetchall("SELECT user_id, total_lookups FROM users ORDER BY total_lookups DESC LIMIT ?", (limit,))
 
-async def get_inactive_users():
+@timed(DB_LATENCY)
+async def get_inactive_users(after: tuple = None, limit: int = -1):
     threshold = (datetime.utcnow() - timedelta(days=30)).isoformat()
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT user_id, last_seen FROM users WHERE last_seen < ?", (threshold,))
-        return await cursor.fetchall()
+    after = after or ("", 0)
+    async with _read() as db:
+        return await db.execute_fetchall(
+            "SELECT user_id, last_seen FROM users WHERE last_seen < ? AND (last_seen, user_id) > (?, ?) "
+            "ORDER BY last_seen, user_id LIMIT ?",
+            (threshold, *after, limit)
+        )
 
+@timed(DB_LATENCY)
 async def get_total_stats():
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT COUNT(*) FROM users")
-        users = (await cursor.fetchone())[0]
-        cursor = await db.execute("SELECT COUNT(*) FROM lookups")
-        lookups = (await cursor.fetchone())[0]
-        return {"users": users, "lookups": lookups}
+    async with _read() as db:
+        counters = dict(await db.execute_fetchall("SELECT name, value FROM counters"))
+        return {"users": counters.get("users", 0), "lookups": counters.get("lookups", 0)}
+
+@timed(DB_LATENCY)
+async def rebuild_counters():
+    async with _write() as db:
+        for statement in REBUILD_COUNTERS:
+            await db.execute(statement)
 
+@timed(DB_LATENCY)
 async def get_daily_stats():
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT date, SUM(count) FROM daily_stats GROUP BY date ORDER BY date DESC LIMIT 30")
-        return await cursor.fetchall()
+    async with _read() as db:
+        return await db.execute_fetchall("SELECT date, SUM(count) FROM daily_stats GROUP BY date ORDER BY date DESC LIMIT 30")
 
+@timed(DB_LATENCY)
 async def get_lookup_stats():
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT command, SUM(count) FROM daily_stats GROUP BY command")
-        return await cursor.fetchall()
+    async with _read() as db:
+        return await db.execute_fetchall("SELECT command, count FROM command_counts ORDER BY command")
 
+@timed(DB_LATENCY)
 async def add_lookup(user_id: int, command: str, query: str, result: str, timestamp: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _write() as db:
         await db.execute(
             "INSERT INTO lookups (user_id, command, query, result, timestamp) VALUES (?, ?, ?, ?, ?)",
             (user_id, command, query, result, timestamp)
         )
-        await db.commit()
+        await db.execute(BUMP_COUNTER, (1, "lookups"))
 
+def queue_lookup(user_id: int, command: str, query: str, result: str, timestamp: str):
+    _buffer.add_lookup(user_id, command, query, result, timestamp)
+
+def queue_daily_stat(date: str, command: str):
+    _buffer.increment_daily_stat(date, command)
+
+@timed(DB_LATENCY)
 async def increment_daily_stat(date: str, command: str):
-    async with aiosqlite.connect(DB_PATH) as db:
+    async with _write() as db:
         await db.execute(
             "INSERT OR REPLACE INTO daily_stats (date, command, count) VALUES (?, ?, COALESCE((SELECT count FROM daily_stats WHERE date = ? AND command = ?), 0) + 1)",
             (date, command, date, command)
         )
-        await db.commit()
+        await db.execute(BUMP_COMMAND_COUNT, (command, 1))
 
 async def is_banned(user_id: int) -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT 1 FROM banned WHERE user_id = ?", (user_id,))
-        return bool(await cursor.fetchone())
+    return user_id in _banned
 
+@timed(DB_LATENCY)
 async def ban_user(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("INSERT OR IGNORE INTO banned (user_id) VALUES (?)", (user_id,))
-        await db.commit()
+    async with _write() as db:
+        async with db.execute("INSERT OR IGNORE INTO banned (user_id) VALUES (?)", (user_id,)) as cursor:
+            changed = cursor.rowcount
+    _banned.add(user_id)
+    _acl_changed(changed)
 
+@timed(DB_LATENCY)
 async def unban_user(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM banned WHERE user_id = ?", (user_id,))
-        await db.commit()
+    async with _write() as db:
+        async with db.execute("DELETE FROM banned WHERE user_id = ?", (user_id,)) as cursor:
+            changed = cursor.rowcount
+    _banned.discard(user_id)
+    _acl_changed(changed)
 
+@timed(DB_LATENCY)
 async def delete_user(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM users WHERE user_id = ?", (user_id,))
-        await db.execute("DELETE FROM lookups WHERE user_id = ?", (user_id,))
-        await db.commit()
+    async with _write() as db:
+        async with db.execute("DELETE FROM users WHERE user_id = ?", (user_id,)) as cursor:
+            users = cursor.rowcount
+        async with db.execute("DELETE FROM lookups WHERE user_id = ?", (user_id,)) as cursor:
+            lookups = cursor.rowcount
+        await db.executemany(BUMP_COUNTER, [(-users, "users"), (-lookups, "lookups")])
 
 async def is_admin(user_id: int) -> bool:
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT 1 FROM admins WHERE user_id = ?", (user_id,))
-        return bool(await cursor.fetchone())
+    return user_id in _admins
 
+@timed(DB_LATENCY)
 async def add_admin(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("INSERT OR IGNORE INTO admins (user_id) VALUES (?)", (user_id,))
-        await db.commit()
+    async with _write() as db:
+        async with db.execute("INSERT OR IGNORE INTO admins (user_id) VALUES (?)", (user_id,)) as cursor:
+            changed = cursor.rowcount
+    _admins.add(user_id)
+    _acl_changed(changed)
 
+@timed(DB_LATENCY)
 async def remove_admin(user_id: int):
-    async with aiosqlite.connect(DB_PATH) as db:
-        await db.execute("DELETE FROM admins WHERE user_id = ?", (user_id,))
-        await db.commit()
+    async with _write() as db:
+        async with db.execute("DELETE FROM admins WHERE user_id = ?", (user_id,)) as cursor:
+            changed = cursor.rowcount
+    _admins.discard(user_id)
+    _acl_changed(changed)
 
+@timed(DB_LATENCY)
 async def get_all_admins():
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute("SELECT user_id FROM admins")
-        return await cursor.fetchall()
+    async with _read() as db:
+        return await db.execute_fetchall("SELECT user_id FROM admins")
+
+def parse_search(query: str):
+    query = query.strip()
+    field, _, value = query.partition(":")
+    if field in ("first", "last") and DATE_PREFIX.fullmatch(value):
+        return f"{field}_seen", value
+    if field == "like" and value:
+        return "like", value
+    if query.isdigit() and not query.startswith("0") and len(query) <= MAX_USER_ID_DIGITS:
+        return "id", query
+    if "-" in query and DATE_PREFIX.fullmatch(query):
+        return "last_seen", query
+    return None
 
-async def search_user(query: str):
-    async with aiosqlite.connect(DB_PATH) as db:
-        cursor = await db.execute(
-            "SELECT * FROM users WHERE user_id LIKE ? OR first_seen LIKE ? OR last_seen LIKE ?",
-            (f"%{query}%", f"%{query}%", f"%{query}%")
+def _id_prefix_ranges(prefix: str):
+    low = high = int(prefix)
+    for _ in range(MAX_USER_ID_DIGITS - len(prefix) + 1):
+        if low > MAX_USER_ID:
+            break
+        yield low, min(high, MAX_USER_ID)
+        low, high = low * 10, high * 10 + 9
+
+@timed(DB_LATENCY)
+async def search_user(query: str, after=None, limit: int = -1):
+    parsed = parse_search(query)
+    if parsed is None:
+        raise ValueError(f"Unrecognized search query: {query!r}")
+    mode, value = parsed
+    async with _read() as db:
+        if mode == "id":
+            rows = []
+            after = -1 if after is None else after
+            for low, high in _id_prefix_ranges(value):
+                if len(rows) == limit:
+                    break
+                if high <= after:
+                    continue
+                rows += await db.execute_fetchall(
+                    "SELECT * FROM users WHERE user_id BETWEEN ? AND ? AND user_id > ? ORDER BY user_id LIMIT ?",
+                    (low, high, after, limit - len(rows) if limit >= 0 else -1)
+                )
+            return rows
+        if mode == "like":
+            return await db.execute_fetchall(
+                "SELECT * FROM users WHERE (user_id LIKE ? OR first_seen LIKE ? OR last_seen LIKE ?) AND user_id > ? "
+                "ORDER BY user_id LIMIT ?",
+                (f"%{value}%", f"%{value}%", f"%{value}%", -2 ** 63 if after is None else after, limit)
+            )
+        upper = value[:-1] + chr(ord(value[-1]) + 1)
+        after = after or ("", 0)
+        return await db.execute_fetchall(
+            f"SELECT * FROM users WHERE {mode} >= ? AND {mode} < ? AND ({mode}, user_id) > (?, ?) "
+            f"ORDER BY {mode}, user_id LIMIT ?",
+            (value, upper, *after, limit)
         )
-        return await cursor.fetchall()
+
+@timed(DB_LATENCY)
+async def get_broadcast_targets():
+    async with _read() as db:
+        return [row[0] for row in await db.execute_fetchall(
+            "SELECT u.user_id FROM users u LEFT JOIN blocked_users b ON b.user_id = u.user_id "
+            "WHERE b.user_id IS NULL OR b.blocked_at < u.last_seen"
+        )]
+
+@timed(DB_LATENCY)
+async def create_broadcast_job(kind: str, from_chat_id: int, message_id: int, user_ids: list,
+                               status_chat_id: int, status_message_id: int) -> int:
+    now = datetime.utcnow().isoformat()
+    async with _write() as db:
+        async with db.execute(
+            "INSERT INTO broadcast_jobs (kind, from_chat_id, message_id, status_chat_id, status_message_id, "
+            "status, total, sent, blocked, failed, created_at) VALUES (?, ?, ?, ?, ?, 'running', ?, 0, 0, 0, ?)",
+            (kind, from_chat_id, message_id, status_chat_id, status_message_id, len(user_ids), now)
+        ) as cursor:
+            job_id = cursor.lastrowid
+        await db.executemany(
+            "INSERT OR IGNORE INTO broadcast_recipients (job_id, user_id, status) VALUES (?, ?, 'pending')",
+            [(job_id, user_id) for user_id in user_ids]
+        )
+    return job_id
+
+@timed(DB_LATENCY)
+async def save_broadcast_progress(job_id: int, results: list, sent: int, blocked: int, failed: int):
+    now = datetime.utcnow().isoformat()
+    async with _write() as db:
+        await db.executemany(
+            "UPDATE broadcast_recipients SET status = ? WHERE job_id = ? AND user_id = ?",
+            [(status, job_id, user_id) for user_id, status in results]
+        )
+        await db.executemany(
+            "INSERT OR REPLACE INTO blocked_users (user_id, blocked_at) VALUES (?, ?)",
+            [(user_id, now) for user_id, status in results if status == "blocked"]
+        )
+        await db.execute(
+            "UPDATE broadcast_jobs SET sent = ?, blocked = ?, failed = ? WHERE id = ?",
+            (sent, blocked, failed, job_id)
+        )
+
+@timed(DB_LATENCY)
+async def finish_broadcast_job(job_id: int, status: str):
+    async with _write() as db:
+        await db.execute(
+            "UPDATE broadcast_jobs SET status = ?, finished_at = ? WHERE id = ?",
+            (status, datetime.utcnow().isoformat(), job_id)
+        )
+
+@timed(DB_LATENCY)
+async def get_unfinished_broadcast_jobs():
+    async with _read() as db:
+        return await db.execute_fetchall(
+            "SELECT id, kind, from_chat_id, message_id, status_chat_id, status_message_id, total, sent, blocked, failed "
+            "FROM broadcast_jobs WHERE status = 'running' ORDER BY id"
+        )
+
+@timed(DB_LATENCY)
+async def get_pending_recipients(job_id: int):
+    async with _read() as db:
+        return [row[0] for row in await db.execute_fetchall(
+            "SELECT user_id FROM broadcast_recipients WHERE job_id = ? AND status = 'pending'", (job_id,)
+        )]
+
+@timed(DB_LATENCY)
+async def load_fsm_states():
+    async with _read() as db:
+        return await db.execute_fetchall("SELECT key, state, data, updated_at FROM fsm_states")
+
+@timed(DB_LATENCY)
+async def save_fsm_states(records: list, deleted: list):
+    async with _write() as db:
+        await db.executemany(
+            "INSERT INTO fsm_states (key, state, data, updated_at) VALUES (?, ?, ?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET state = excluded.state, data = excluded.data, updated_at = excluded.updated_at",
+            records
+        )
+        await db.executemany("DELETE FROM fsm_states WHERE key = ?", [(key,) for key in deleted])
+
+@timed(DB_LATENCY)
+async def expire_fsm_states(before: float) -> int:
+    async with _write() as db:
+        async with db.execute("DELETE FROM fsm_states WHERE updated_at < ?", (before,)) as cursor:
+            return cursor.rowcount
+
+async def auto_vacuum_mode() -> int:
+    async with _write_lock:
+        return (await _writer.execute_fetchall("PRAGMA auto_vacuum"))[0][0]
+
+@timed(DB_LATENCY)
+async def enable_incremental_vacuum() -> bool:
+    if await auto_vacuum_mode() == 2:
+        return False
+    await _buffer.flush()
+    async with _write_lock:
+        await _writer.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        await _writer.execute("VACUUM")
+    return True
+
+async def _database_pages():
+    async with _read() as db:
+        page_count = (await db.execute_fetchall("PRAGMA page_count"))[0][0]
+        page_size = (await db.execute_fetchall("PRAGMA page_size"))[0][0]
+    return page_count, page_size
+
+@timed(DB_LATENCY)
+async def prune_lookups(max_age_days: int, max_rows: int, batch_size: int = 500, pause: float = 0.05):
+    started = time.monotonic()
+    pages_before, page_size = await _database_pages()
+    incremental = await auto_vacuum_mode() == 2
+    expired = 0
+    if max_age_days:
+        cutoff = (datetime.utcnow() - timedelta(days=max_age_days)).isoformat()
+        while True:
+            async with _read() as db:
+                rows = await db.execute_fetchall(
+                    "SELECT id FROM lookups WHERE timestamp < ? AND id <= (SELECT MAX(id) FROM "
+                    "(SELECT id FROM lookups ORDER BY id LIMIT ?))", (cutoff, batch_size)
+                )
+            if not rows:
+                break
+            async with _write() as db:
+                async with db.execute(
+                    f"DELETE FROM lookups WHERE id IN ({','.join('?' * len(rows))})", [row[0] for row in rows]
+                ) as cursor:
+                    deleted = cursor.rowcount
+                await db.execute(BUMP_COUNTER, (-deleted, "lookups"))
+            expired += deleted
+            await asyncio.sleep(pause)
+    capped = 0
+    if max_rows:
+        async with _read() as db:
+            excess = (await db.execute_fetchall("SELECT value FROM counters WHERE name = 'lookups'"))[0][0] - max_rows
+        while excess > 0:
+            async with _write() as db:
+                async with db.execute(
+                    "DELETE FROM lookups WHERE id IN (SELECT id FROM lookups ORDER BY id LIMIT ?)",
+                    (min(batch_size, excess),)
+                ) as cursor:
+                    deleted = cursor.rowcount
+                await db.execute(BUMP_COUNTER, (-deleted, "lookups"))
+            if not deleted:
+                break
+            capped += deleted
+            excess -= deleted
+            await asyncio.sleep(pause)
+    previous = None
+    while incremental:
+        async with _write() as db:
+            freelist = (await db.execute_fetchall("PRAGMA freelist_count"))[0][0]
+            if not freelist or freelist == previous:
+                break
+            await db.execute_fetchall(f"PRAGMA incremental_vacuum({batch_size})")
+        previous = freelist
+        await asyncio.sleep(pause)
+    pages_after, _ = await _database_pages()
+    return {
+        "expired": expired,
+        "capped": capped,
+        "reclaimed": (pages_before - pages_after) * page_size,
+        "size": pages_after * page_size,
+        "incremental": incremental,
+        "duration": time.monotonic() - started,
+    }
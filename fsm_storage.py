@@ -0,0 +1,118 @@
+# fsm_storage.py
+import asyncio
+import json
+import logging
+import time
+from typing import Any, Dict, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+
+from database import expire_fsm_states, load_fsm_states, save_fsm_states
+
+SWEEP_INTERVAL = 60
+
+logger = logging.getLogger(__name__)
+
+class SQLiteStorage(BaseStorage):
+    def __init__(self, ttl: float = 86400, flush_interval: float = 1.0, key_builder: Optional[KeyBuilder] = None):
+        self.ttl = ttl
+        self.flush_interval = flush_interval
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._records = {}
+        self._dirty = set()
+        self._task = None
+        self._flushing = None
+
+    async def start(self):
+        expired = await expire_fsm_states(time.time() - self.ttl)
+        for key, state, data, updated_at in await load_fsm_states():
+            self._records[key] = [state, json.loads(data), updated_at]
+        logger.info("Loaded %s FSM states, expired %s", len(self._records), expired)
+        self._task = asyncio.create_task(self._run())
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self._flushing is not None:
+            await asyncio.gather(self._flushing, return_exceptions=True)
+            self._flushing = None
+        await self.flush()
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        record = self._get(key)
+        self._put(key, state.state if isinstance(state, State) else state, record[1] if record else {})
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        record = self._get(key)
+        return record[0] if record else None
+
+    async def set_data(self, key: StorageKey, data: Dict[str, Any]) -> None:
+        record = self._get(key)
+        self._put(key, record[0] if record else None, data.copy())
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        record = self._get(key)
+        return record[1].copy() if record else {}
+
+    def _get(self, key: StorageKey):
+        name = self.key_builder.build(key)
+        record = self._records.get(name)
+        if record is not None and time.time() - record[2] > self.ttl:
+            del self._records[name]
+            self._dirty.add(name)
+            return None
+        return record
+
+    def _put(self, key: StorageKey, state: Optional[str], data: Dict[str, Any]):
+        name = self.key_builder.build(key)
+        if state is None and not data:
+            self._records.pop(name, None)
+        else:
+            self._records[name] = [state, data, time.time()]
+        self._dirty.add(name)
+
+    async def _sweep(self):
+        threshold = time.time() - self.ttl
+        for name in [name for name, record in self._records.items() if record[2] < threshold]:
+            del self._records[name]
+        await expire_fsm_states(threshold)
+
+    async def _run(self):
+        swept_at = time.monotonic()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if time.monotonic() - swept_at >= SWEEP_INTERVAL:
+                swept_at = time.monotonic()
+                try:
+                    await self._sweep()
+                except Exception:
+                    logger.exception("Failed to expire FSM states")
+            self._flushing = asyncio.ensure_future(self.flush())
+            try:
+                await asyncio.shield(self._flushing)
+            except Exception:
+                logger.exception("Failed to flush FSM states")
+
+    async def flush(self):
+        if not self._dirty:
+            return
+        names, self._dirty = self._dirty, set()
+        records = []
+        deleted = []
+        for name in names:
+            record = self._records.get(name)
+            if record is None:
+                deleted.append(name)
+            else:
+                records.append((name, record[0], json.dumps(record[1], default=str), record[2]))
+        try:
+            await save_fsm_states(records, deleted)
+        except BaseException:
+            self._dirty |= names
+            raise
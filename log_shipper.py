@@ -0,0 +1,129 @@
+# log_shipper.py
+import asyncio
+import logging
+import time
+from collections import deque
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import BufferedInputFile
+
+MESSAGE_LIMIT = 4096
+SEPARATOR = "\n\n"
+MAX_MESSAGES_PER_FLUSH = 3
+
+logger = logging.getLogger(__name__)
+
+def message_length(text: str) -> int:
+    return len(text.encode("utf-16-le")) // 2
+
+def pack(entries: list) -> list:
+    batches = []
+    current = ""
+    for entry in entries:
+        if current and message_length(current) + len(SEPARATOR) + message_length(entry) <= MESSAGE_LIMIT:
+            current += SEPARATOR + entry
+        else:
+            if current:
+                batches.append(current)
+            current = entry
+    if current:
+        batches.append(current)
+    return batches
+
+class LogChannel:
+    def __init__(self, max_pending: int):
+        self.pending = deque(maxlen=max_pending)
+        self.ready = asyncio.Event()
+        self.task = None
+
+class LogShipper:
+    def __init__(self, bot: Bot, interval: float, max_pending: int, max_attempts: int = 3):
+        self.bot = bot
+        self.interval = interval
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        self.channels = {}
+        self.shipped = 0
+        self.messages = 0
+        self.documents = 0
+        self.dropped = 0
+        self.failed = 0
+        self._closing = False
+
+    def submit(self, channel_id: int, text: str):
+        channel = self.channels.get(channel_id)
+        if channel is None:
+            channel = self.channels[channel_id] = LogChannel(self.max_pending)
+            channel.task = asyncio.create_task(self._run(channel_id, channel))
+        if len(channel.pending) == self.max_pending:
+            self.dropped += 1
+        channel.pending.append(text)
+        channel.ready.set()
+
+    def pending(self) -> int:
+        return sum(len(channel.pending) for channel in self.channels.values())
+
+    def stats(self) -> dict:
+        return {
+            "channels": len(self.channels),
+            "pending": self.pending(),
+            "shipped": self.shipped,
+            "messages": self.messages,
+            "documents": self.documents,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+    async def close(self, timeout: float = 5):
+        self._closing = True
+        tasks = [channel.task for channel in self.channels.values()]
+        for channel in self.channels.values():
+            channel.ready.set()
+        if not tasks:
+            return
+        _, unfinished = await asyncio.wait(tasks, timeout=timeout)
+        if unfinished:
+            logger.warning("Dropping %s log entries on shutdown", self.pending())
+        for task in unfinished:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _run(self, channel_id: int, channel: LogChannel):
+        while True:
+            if not channel.pending:
+                if self._closing:
+                    return
+                channel.ready.clear()
+                await channel.ready.wait()
+                continue
+            entries = list(channel.pending)
+            channel.pending.clear()
+            try:
+                await self._ship(channel_id, entries)
+            except Exception:
+                self.failed += len(entries)
+                logger.exception("Failed to ship %s log entries to %s", len(entries), channel_id)
+            if not self._closing:
+                await asyncio.sleep(self.interval)
+
+    async def _ship(self, channel_id: int, entries: list):
+        batches = pack(entries)
+        if len(batches) > MAX_MESSAGES_PER_FLUSH or any(message_length(b) > MESSAGE_LIMIT for b in batches):
+            document = BufferedInputFile(SEPARATOR.join(entries).encode(), filename=f"log-{int(time.time())}.txt")
+            await self._deliver(lambda: self.bot.send_document(channel_id, document, caption=f"{len(entries)} entries"))
+            self.documents += 1
+        else:
+            for batch in batches:
+                await self._deliver(lambda: self.bot.send_message(channel_id, batch))
+                self.messages += 1
+        self.shipped += len(entries)
+
+    async def _deliver(self, send):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                return await send()
+            except TelegramRetryAfter as e:
+                if attempt == self.max_attempts:
+                    raise
+                await asyncio.sleep(e.retry_after)
@@ -1,31 +1,50 @@
 # main.py
 import asyncio
+import copy
+import html
 import json
 import logging
 import os
+import random
+import shutil
+import tempfile
+import time
+from collections import OrderedDict
 from datetime import datetime
 from functools import wraps
 from typing import Any, Dict
+from urllib.parse import urlsplit
 
 import aiohttp
 from aiohttp import web
 from aiogram import Bot, Dispatcher, Router, types
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
 from aiogram.enums import ParseMode
 from aiogram.exceptions import TelegramRetryAfter, TelegramForbiddenError
 from aiogram.filters import Command
 from aiogram.filters.callback_data import CallbackData
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.types import InlineKeyboardButton, InlineKeyboardMarkup, Message, CallbackQuery, FSInputFile
+from aiogram.types import (
+    BufferedInputFile, InlineKeyboardButton, InlineKeyboardMarkup, Message, CallbackQuery, FSInputFile
+)
 from dotenv import load_dotenv
 
+from backup import create_snapshot, prune_snapshots, snapshot_age
+from broadcast import BroadcastEngine
 from database import (
-    init_db, add_user, update_user, get_user, get_all_users, get_recent_users, get_user_lookups,
+    DB_PATH, init_db, close_db, add_user, get_user, get_recent_users, get_user_lookups,
     get_leaderboard, get_inactive_users, get_total_stats, get_daily_stats, get_lookup_stats,
-    add_lookup, increment_daily_stat, is_banned, ban_user, unban_user, delete_user,
-    is_admin, add_admin, remove_admin, get_all_admins, search_user
+    queue_user_update, queue_lookup, queue_daily_stat, is_banned, ban_user, unban_user, delete_user,
+    is_admin, add_admin, remove_admin, get_all_admins, search_user, parse_search, get_broadcast_targets,
+    rebuild_counters, prune_lookups, auto_vacuum_mode, enable_incremental_vacuum
 )
+from fsm_storage import SQLiteStorage
+from log_shipper import MESSAGE_LIMIT, LogShipper
+from metrics import Counter, Gauge, Histogram, render as render_metrics
+from ratelimit import KeyedBuckets
+import tracing
+from update_queue import UpdateQueue
 
 load_dotenv()
 
@@ -38,12 +57,77 @@ TOKEN = os.getenv("TOKEN")
 WEBHOOK_URL = os.getenv("WEBHOOK_URL")
 WEBHOOK_PATH = "/webhook"
 PORT = int(os.getenv("PORT", 8080))
+MEMBER_CACHE_SIZE = int(os.getenv("MEMBER_CACHE_SIZE", 10000))
+MEMBER_CACHE_TTL = int(os.getenv("MEMBER_CACHE_TTL", 600))
+MEMBER_CACHE_NEGATIVE_TTL = int(os.getenv("MEMBER_CACHE_NEGATIVE_TTL", 20))
+HTTP_LIMIT = int(os.getenv("HTTP_LIMIT", 100))
+HTTP_LIMIT_PER_HOST = int(os.getenv("HTTP_LIMIT_PER_HOST", 20))
+HTTP_KEEPALIVE = float(os.getenv("HTTP_KEEPALIVE", 60))
+HTTP_DNS_TTL = int(os.getenv("HTTP_DNS_TTL", 300))
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", 30))
+BREAKER_FAILURES = int(os.getenv("BREAKER_FAILURES", 5))
+BREAKER_COOLDOWN = float(os.getenv("BREAKER_COOLDOWN", 30))
+MAX_RETRY_AFTER = 10
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", 25))
+BROADCAST_WORKERS = int(os.getenv("BROADCAST_WORKERS", 8))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", 16))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", 1000))
+RATE_USER_PER_MINUTE = float(os.getenv("RATE_USER_PER_MINUTE", 10))
+RATE_USER_BURST = float(os.getenv("RATE_USER_BURST", 5))
+RATE_CHAT_PER_MINUTE = float(os.getenv("RATE_CHAT_PER_MINUTE", 60))
+RATE_CHAT_BURST = float(os.getenv("RATE_CHAT_BURST", 20))
+RATE_MAX_KEYS = int(os.getenv("RATE_MAX_KEYS", 50000))
+LOG_CHANNEL_INTERVAL = float(os.getenv("LOG_CHANNEL_INTERVAL", 3))
+LOG_CHANNEL_MAX_PENDING = int(os.getenv("LOG_CHANNEL_MAX_PENDING", 500))
+LOOKUP_MAX_AGE_DAYS = int(os.getenv("LOOKUP_MAX_AGE_DAYS", 0))
+LOOKUP_MAX_ROWS = int(os.getenv("LOOKUP_MAX_ROWS", 0))
+RETENTION_INTERVAL = int(os.getenv("RETENTION_INTERVAL", 3600))
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", 86400))
+BACKUP_DIR = os.getenv("BACKUP_DIR")
+BACKUP_INTERVAL_HOURS = float(os.getenv("BACKUP_INTERVAL_HOURS", 24))
+BACKUP_KEEP = int(os.getenv("BACKUP_KEEP", 7))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", 0))
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", 1000))
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.log")
+PAGE_SIZE = 20
+RESULT_FOOTER = "\ndeveloper: @Nullprotocol_X\npowered_by: NULL PROTOCOL"
+MAX_RESULT_CHUNKS = 3
+SEARCH_SORT_COLUMNS = {"first_seen": 1, "last_seen": 2}
+SEARCH_USAGE = (
+    "Usage: /searchuser <query>\n"
+    "<digits> - user ID prefix\n"
+    "<YYYY-MM[-DD]> or last:<YYYY[-MM[-DD]]> - last seen in that period\n"
+    "first:<YYYY[-MM[-DD]]> - first seen in that period\n"
+    "like:<text> - substring match (slow)"
+)
+
+COMMAND_LATENCY = Histogram("bot_command_seconds", "Message handler latency per command", ("command",))
+UPSTREAM_LATENCY = Histogram("bot_upstream_seconds", "fetch_api latency per upstream host", ("host",))
+TELEGRAM_CALLS = Counter("bot_telegram_calls_total", "Telegram Bot API calls per method", ("method",))
+RATE_LIMITED = Counter("bot_rate_limited_total", "Commands rejected by the rate limiter per scope", ("scope",))
+TELEGRAM_RETRY_AFTER = Counter("bot_telegram_retry_after_total", "Telegram flood-wait responses per method", ("method",))
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        name = method.__api_method__
+        TELEGRAM_CALLS.inc(name)
+        try:
+            with tracing.span(f"telegram {name}"):
+                return await make_request(bot, method)
+        except TelegramRetryAfter:
+            TELEGRAM_RETRY_AFTER.inc(name)
+            raise
 
 bot = Bot(TOKEN)
-storage = MemoryStorage()
+bot.session.middleware(TelegramMetricsMiddleware())
+storage = SQLiteStorage(FSM_STATE_TTL)
 dp = Dispatcher(storage=storage)
 router = Router()
 dp.include_router(router)
+broadcaster = BroadcastEngine(bot, BROADCAST_RATE, BROADCAST_WORKERS)
+log_shipper = LogShipper(bot, LOG_CHANNEL_INTERVAL, LOG_CHANNEL_MAX_PENDING)
 
 logging.basicConfig(level=logging.INFO)
 
@@ -77,23 +161,23 @@ LOG_CHANNELS = {
 }
 
 COMMANDS = {
-    "num": {"url": "https://num-free-rootx-jai-shree-ram-14-day.vercel.app/?key=lundkinger&number={query}", "log": "NUM", "extra_clean": True},
-    "adr": {"url": "https://api-ij32.onrender.com/aadhar?match={query}", "log": "ADR", "extra_clean": False},
-    "tg2num": {"url": "https://tg2num-owner-api.vercel.app/?userid={query}", "log": "TG2NUM", "extra_clean": False},
-    "vehicle": {"url": "https://vehicle-info-aco-api.vercel.app/info?vehicle={query}", "log": "VEHICLE", "extra_clean": False},
-    "vchalan": {"url": "https://api.b77bf911.workers.dev/vehicle?registration={query}", "log": "VCHALAN", "extra_clean": False},
-    "ip": {"url": "https://abbas-apis.vercel.app/api/ip?ip={query}", "log": "IP", "extra_clean": False},
-    "email": {"url": "https://abbas-apis.vercel.app/api/email?mail={query}", "log": "EMAIL", "extra_clean": False},
-    "ffinfo": {"url": "https://official-free-fire-info.onrender.com/player-info?key=DV_M7-INFO_API&uid={query}", "log": "FFINFO", "extra_clean": False},
-    "ffban": {"url": "https://abbas-apis.vercel.app/api/ff-ban?uid={query}", "log": "FFBAN", "extra_clean": False},
-    "pin": {"url": "https://api.postalpincode.in/pincode/{query}", "log": "PIN", "extra_clean": False},
-    "ifsc": {"url": "https://abbas-apis.vercel.app/api/ifsc?ifsc={query}", "log": "IFSC", "extra_clean": False},
-    "gst": {"url": "https://api.b77bf911.workers.dev/gst?number={query}", "log": "GST", "extra_clean": False},
-    "insta": {"url": "https://mkhossain.alwaysdata.net/instanum.php?username={query}", "log": "INSTA", "extra_clean": False},
-    "tginfo": {"url": "https://openosintx.vippanel.in/tgusrinfo.php?key=OpenOSINTX-FREE&user={query}", "log": "TGINFO", "extra_clean": False},
-    "tginfopro": {"url": "https://api.b77bf911.workers.dev/telegram?user={query}", "log": "TGINFOPRO", "extra_clean": False},
-    "git": {"url": "https://abbas-apis.vercel.app/api/github?username={query}", "log": "GIT", "extra_clean": False},
-    "pak": {"url": "https://abbas-apis.vercel.app/api/pakistan?number={query}", "log": "PAK", "extra_clean": False}
+    "num": {"url": "https://num-free-rootx-jai-shree-ram-14-day.vercel.app/?key=lundkinger&number={query}", "log": "NUM", "extra_clean": True, "timeout": 15},
+    "adr": {"url": "https://api-ij32.onrender.com/aadhar?match={query}", "log": "ADR", "extra_clean": False, "timeout": 45, "cost": 2},
+    "tg2num": {"url": "https://tg2num-owner-api.vercel.app/?userid={query}", "log": "TG2NUM", "extra_clean": False, "timeout": 15},
+    "vehicle": {"url": "https://vehicle-info-aco-api.vercel.app/info?vehicle={query}", "log": "VEHICLE", "extra_clean": False, "timeout": 15},
+    "vchalan": {"url": "https://api.b77bf911.workers.dev/vehicle?registration={query}", "log": "VCHALAN", "extra_clean": False, "timeout": 20},
+    "ip": {"url": "https://abbas-apis.vercel.app/api/ip?ip={query}", "log": "IP", "extra_clean": False, "timeout": 10},
+    "email": {"url": "https://abbas-apis.vercel.app/api/email?mail={query}", "log": "EMAIL", "extra_clean": False, "timeout": 15},
+    "ffinfo": {"url": "https://official-free-fire-info.onrender.com/player-info?key=DV_M7-INFO_API&uid={query}", "log": "FFINFO", "extra_clean": False, "timeout": 45, "cost": 2},
+    "ffban": {"url": "https://abbas-apis.vercel.app/api/ff-ban?uid={query}", "log": "FFBAN", "extra_clean": False, "timeout": 15},
+    "pin": {"url": "https://api.postalpincode.in/pincode/{query}", "log": "PIN", "extra_clean": False, "timeout": 15},
+    "ifsc": {"url": "https://abbas-apis.vercel.app/api/ifsc?ifsc={query}", "log": "IFSC", "extra_clean": False, "timeout": 10},
+    "gst": {"url": "https://api.b77bf911.workers.dev/gst?number={query}", "log": "GST", "extra_clean": False, "timeout": 20},
+    "insta": {"url": "https://mkhossain.alwaysdata.net/instanum.php?username={query}", "log": "INSTA", "extra_clean": False, "timeout": 20},
+    "tginfo": {"url": "https://openosintx.vippanel.in/tgusrinfo.php?key=OpenOSINTX-FREE&user={query}", "log": "TGINFO", "extra_clean": False, "timeout": 20},
+    "tginfopro": {"url": "https://api.b77bf911.workers.dev/telegram?user={query}", "log": "TGINFOPRO", "extra_clean": False, "timeout": 20},
+    "git": {"url": "https://abbas-apis.vercel.app/api/github?username={query}", "log": "GIT", "extra_clean": False, "timeout": 15},
+    "pak": {"url": "https://abbas-apis.vercel.app/api/pakistan?number={query}", "log": "PAK", "extra_clean": False, "timeout": 15}
 }
 
 class BroadcastForm(StatesGroup):
@@ -116,26 +200,120 @@ class AccessMiddleware:
                 await event.reply("You are banned.")
                 return
             if user_id != OWNER_ID and not await is_admin(user_id):
-                joined1 = await check_member(CHANNEL1_ID, user_id)
-                joined2 = await check_member(CHANNEL2_ID, user_id)
+                with tracing.span("check_member"):
+                    joined1, joined2 = await asyncio.gather(
+                        check_member(CHANNEL1_ID, user_id), check_member(CHANNEL2_ID, user_id)
+                    )
                 if not joined1 or not joined2:
                     kb = InlineKeyboardMarkup(inline_keyboard=[
-                        [InlineKeyboardButton("Join Channel 1", url=CHANNEL1_URL)],
-                        [InlineKeyboardButton("Join Channel 2", url=CHANNEL2_URL)],
-                        [InlineKeyboardButton("Retry", callback_data="retry_join")]
+                        [InlineKeyboardButton(text="Join Channel 1", url=CHANNEL1_URL)],
+                        [InlineKeyboardButton(text="Join Channel 2", url=CHANNEL2_URL)],
+                        [InlineKeyboardButton(text="Retry", callback_data="retry_join")]
                     ])
                     await event.reply("Please join both channels to use the bot.", reply_markup=kb)
                     return
         await handler(event, data)
 
+class MetricsMiddleware:
+    async def __call__(self, handler, event: Message, data: Dict[str, Any]):
+        command = data["handler"].callback.__name__
+        tracing.annotate(command=command, user=event.from_user.id)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        finally:
+            COMMAND_LATENCY.observe(time.perf_counter() - started, command)
+
+class RateLimitMiddleware:
+    def __init__(self, scope: str, per_minute: float, burst: float, charge: bool):
+        self.scope = scope
+        self.charge = charge
+        self.buckets = KeyedBuckets(per_minute / 60, burst, RATE_MAX_KEYS)
+        self.warned = OrderedDict()
+
+    async def __call__(self, handler, event: Message, data: Dict[str, Any]):
+        config = COMMANDS.get(data["handler"].callback.__name__)
+        user_id = event.from_user.id
+        if config is None or user_id == OWNER_ID or await is_admin(user_id):
+            return await handler(event, data)
+        cost = config.get("cost", 1)
+        held = data.setdefault("rate_buckets", [])
+        if self.scope == "user" or event.chat.type != "private":
+            key = user_id if self.scope == "user" else event.chat.id
+            bucket = self.buckets.get(key)
+            wait = bucket.delay(cost)
+            if wait > 0:
+                RATE_LIMITED.inc(self.scope)
+                await self.warn(event, key, wait)
+                return
+            held.append(bucket)
+        if self.charge:
+            for bucket in held:
+                bucket.try_take(cost)
+        return await handler(event, data)
+
+    async def warn(self, event: Message, key: int, wait: float):
+        now = time.monotonic()
+        if self.warned.get(key, 0) > now:
+            return
+        self.warned[key] = now + wait
+        self.warned.move_to_end(key)
+        while len(self.warned) > RATE_MAX_KEYS:
+            self.warned.popitem(last=False)
+        who = "You are" if self.scope == "user" else "This chat is"
+        await event.reply(f"{who} sending commands too fast. Try again in {int(wait) + 1}s.")
+
+user_limiter = RateLimitMiddleware("user", RATE_USER_PER_MINUTE, RATE_USER_BURST, charge=False)
+chat_limiter = RateLimitMiddleware("chat", RATE_CHAT_PER_MINUTE, RATE_CHAT_BURST, charge=True)
+
+router.message.middleware(MetricsMiddleware())
+router.message.middleware(user_limiter)
 router.message.middleware(AccessMiddleware())
+router.message.middleware(chat_limiter)
+
+class MembershipCache:
+    def __init__(self, max_size: int, ttl: float, negative_ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+
+    def get(self, chat_id: int, user_id: int):
+        key = (chat_id, user_id)
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        joined, expires = entry
+        if expires <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return joined
+
+    def set(self, chat_id: int, user_id: int, joined: bool):
+        ttl = self.ttl if joined else self.negative_ttl
+        self._entries[(chat_id, user_id)] = (joined, time.monotonic() + ttl)
+        self._entries.move_to_end((chat_id, user_id))
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: int, *chat_ids: int):
+        for chat_id in chat_ids:
+            self._entries.pop((chat_id, user_id), None)
+
+member_cache = MembershipCache(MEMBER_CACHE_SIZE, MEMBER_CACHE_TTL, MEMBER_CACHE_NEGATIVE_TTL)
 
 async def check_member(chat_id: int, user_id: int) -> bool:
+    joined = member_cache.get(chat_id, user_id)
+    if joined is not None:
+        return joined
     try:
         member = await bot.get_chat_member(chat_id, user_id)
-        return member.status in ("member", "administrator", "creator")
     except (TelegramForbiddenError, Exception):
         return False
+    joined = member.status in ("member", "administrator", "creator")
+    member_cache.set(chat_id, user_id, joined)
+    return joined
 
 def admin_required(func):
     @wraps(func)
@@ -156,49 +334,274 @@ def owner_required(func):
             await message.reply("You are not the owner.")
     return wrapper
 
-def clean_branding(data: Any, extra: bool = False) -> Any:
-    str_data = json.dumps(data) if isinstance(data, (dict, list)) else str(data)
-    removes = GLOBAL_REMOVES.copy()
-    if extra:
-        removes.extend(NUM_EXTRA_REMOVES)
+BRANDING_REMOVES = {
+    False: tuple(GLOBAL_REMOVES),
+    True: tuple(GLOBAL_REMOVES + NUM_EXTRA_REMOVES),
+}
+# Patterns made of plain ASCII that cannot reach JSON syntax only ever match
+# inside a single string value, so they are replaced per leaf. Non-ASCII ones
+# never matched, json.dumps escapes that text. Matches in keys, in escaped text
+# or in number/literal tokens still take the JSON round trip.
+JSON_SCALAR_CHARS = frozenset("0123456789+-.eEtruefalsnNIiy")
+BRANDING_LEAF_SAFE = {
+    extra: all(
+        not r.isascii() or (r.isprintable() and not r.startswith(" ") and not any(c in r for c in '"\\,:[]{}'))
+        for r in removes
+    )
+    for extra, removes in BRANDING_REMOVES.items()
+}
+BRANDING_SCALAR_REMOVES = {
+    extra: tuple(r for r in removes if set(r) <= JSON_SCALAR_CHARS)
+    for extra, removes in BRANDING_REMOVES.items()
+}
+
+class _BrandingFallback(Exception):
+    pass
+
+def _plain_json_text(text: str) -> bool:
+    return text.isascii() and '"' not in text and "\\" not in text and text.isprintable()
+
+def _check_text(text: str, removes: tuple):
     for r in removes:
-        str_data = str_data.replace(r, "")
+        if r in text:
+            raise _BrandingFallback
+
+def _strip_leaves(node: Any, removes: tuple, scalar_removes: tuple) -> Any:
+    kind = type(node)
+    if kind is str:
+        if not _plain_json_text(node):
+            _check_text(json.dumps(node), removes)
+            return node
+        for i, r in enumerate(removes):
+            if r in node:
+                for r in removes[i:]:
+                    node = node.replace(r, "")
+                break
+        return node
+    if kind is dict:
+        out = {}
+        changed = False
+        for key, value in node.items():
+            _check_text(key if type(key) is str and _plain_json_text(key) else json.dumps(key), removes)
+            out[key] = cleaned = _strip_leaves(value, removes, scalar_removes)
+            changed = changed or cleaned is not value
+        return out if changed else node
+    if kind is list:
+        out = [_strip_leaves(value, removes, scalar_removes) for value in node]
+        return out if any(a is not b for a, b in zip(out, node)) else node
+    if scalar_removes:
+        _check_text(json.dumps(node), scalar_removes)
+    return node
+
+def clean_branding(data: Any, extra: bool = False) -> Any:
+    is_json = isinstance(data, (dict, list))
+    str_data = json.dumps(data) if is_json else str(data)
+    removes = BRANDING_REMOVES[extra]
+    # Replacing in order, every pattern ahead of the first one present is a
+    # no-op, so scanning starts there; with nothing present, data is returned
+    # as is.
+    first = next((i for i, r in enumerate(removes) if r in str_data), None)
+    if first is None:
+        if is_json:
+            return data
+    else:
+        if is_json and BRANDING_LEAF_SAFE[extra]:
+            try:
+                return _strip_leaves(data, removes[first:], BRANDING_SCALAR_REMOVES[extra])
+            except _BrandingFallback:
+                pass
+        for r in removes[first:]:
+            str_data = str_data.replace(r, "")
     try:
         return json.loads(str_data)
     except json.JSONDecodeError:
         return {"response": str_data}
 
-async def fetch_api(url: str, retries: int = 3, backoff: int = 1) -> Dict:
-    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=30)) as session:
-        for attempt in range(retries):
-            try:
-                async with session.get(url) as response:
-                    if response.status == 200:
-                        text = await response.text()
-                        try:
-                            return json.loads(text)
-                        except json.JSONDecodeError:
-                            return {"response": text}
-            except Exception:
-                await asyncio.sleep(backoff * (2 ** attempt))
-        return {"error": "API request failed"}
-
-async def log_to_channel(cmd: str, data: Dict, user_id: int, query: str, group_id: int):
-    channel_id = LOG_CHANNELS.get(cmd.upper())
-    if channel_id:
-        text = f"User ID: {user_id}\nGroup ID: {group_id}\nQuery: {query}\nResult:\n{json.dumps(data, indent=2)}"
+http_session = None
+
+async def start_http_session():
+    global http_session
+    connector = aiohttp.TCPConnector(
+        limit=HTTP_LIMIT,
+        limit_per_host=HTTP_LIMIT_PER_HOST,
+        keepalive_timeout=HTTP_KEEPALIVE,
+        ttl_dns_cache=HTTP_DNS_TTL,
+    )
+    http_session = aiohttp.ClientSession(connector=connector, timeout=aiohttp.ClientTimeout(total=HTTP_TIMEOUT))
+
+async def close_http_session():
+    global http_session
+    if http_session is not None:
+        await http_session.close()
+        http_session = None
+
+def http_pool_stats() -> Dict:
+    connector = http_session.connector
+    hosts = {}
+    for key, conns in connector._conns.items():
+        hosts.setdefault(key.host, {"in_use": 0, "idle": 0, "waiting": 0})["idle"] += len(conns)
+    for key, conns in connector._acquired_per_host.items():
+        hosts.setdefault(key.host, {"in_use": 0, "idle": 0, "waiting": 0})["in_use"] += len(conns)
+    for key, waiters in connector._waiters.items():
+        hosts.setdefault(key.host, {"in_use": 0, "idle": 0, "waiting": 0})["waiting"] += len(waiters)
+    return {
+        "limit": connector.limit,
+        "limit_per_host": connector.limit_per_host,
+        "in_use": len(connector._acquired),
+        "idle": sum(h["idle"] for h in hosts.values()),
+        "hosts": hosts,
+    }
+
+class CircuitBreaker:
+    def __init__(self, threshold: int, cooldown: float):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.rejected = 0
+
+    def allow(self) -> bool:
+        if self.state == "open":
+            if time.monotonic() - self.opened_at < self.cooldown:
+                self.rejected += 1
+                return False
+            self.state = "half_open"
+        if self.state == "half_open":
+            if self.probing:
+                self.rejected += 1
+                return False
+            self.probing = True
+        return True
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self.probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        self.probing = False
+        if self.state == "half_open" or self.failures >= self.threshold:
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def retry_in(self) -> float:
+        if self.state != "open":
+            return 0.0
+        return max(0.0, self.cooldown - (time.monotonic() - self.opened_at))
+
+breakers: Dict[str, CircuitBreaker] = {}
+
+def get_breaker(host: str) -> CircuitBreaker:
+    breaker = breakers.get(host)
+    if breaker is None:
+        breaker = breakers[host] = CircuitBreaker(BREAKER_FAILURES, BREAKER_COOLDOWN)
+    return breaker
+
+class SingleFlight:
+    def __init__(self):
+        self.calls: Dict[Any, list] = {}
+        self.started = 0
+        self.coalesced = 0
+
+    async def do(self, key, factory):
+        flight = self.calls.get(key)
+        if flight is None:
+            self.started += 1
+            flight = self.calls[key] = [asyncio.create_task(self._run(key, factory)), 1]
+        else:
+            self.coalesced += 1
+            flight[1] += 1
+        result = await asyncio.shield(flight[0])
+        return copy.deepcopy(result) if flight[1] > 1 else result
+
+    async def _run(self, key, factory):
         try:
-            await bot.send_message(channel_id, text)
+            return await factory()
+        finally:
+            del self.calls[key]
+
+upstream_flights = SingleFlight()
+
+def retry_after(response) -> float:
+    try:
+        return min(float(response.headers.get("Retry-After", 0)), MAX_RETRY_AFTER)
+    except ValueError:
+        return 0.0
+
+async def fetch_api(url: str, retries: int = 3, backoff: int = 1, timeout: float = HTTP_TIMEOUT) -> Dict:
+    host = urlsplit(url).hostname
+    started = time.perf_counter()
+    try:
+        with tracing.span(f"fetch_api {host}"):
+            return await request_api(url, get_breaker(host), retries, backoff, timeout)
+    finally:
+        UPSTREAM_LATENCY.observe(time.perf_counter() - started, host)
+
+async def request_api(url: str, breaker: CircuitBreaker, retries: int, backoff: int, timeout: float) -> Dict:
+    for attempt in range(retries):
+        if not breaker.allow():
+            return {"error": "API temporarily unavailable"}
+        delay = backoff * (2 ** attempt)
+        try:
+            async with http_session.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                if response.status == 200:
+                    text = await response.text()
+                    breaker.record_success()
+                    try:
+                        return json.loads(text)
+                    except json.JSONDecodeError:
+                        return {"response": text}
+                if response.status not in RETRYABLE_STATUSES:
+                    breaker.record_success()
+                    return {"error": f"API returned {response.status}"}
+                breaker.record_failure()
+                delay = max(delay, retry_after(response))
+        except asyncio.TimeoutError:
+            breaker.record_failure()
+            return {"error": "API request timed out"}
         except Exception:
-            pass
+            breaker.record_failure()
+        if attempt + 1 < retries:
+            await asyncio.sleep(delay * random.uniform(0.5, 1))
+    return {"error": "API request failed"}
 
-async def send_result(message: Message, data: Dict, query: str):
-    html = f'<pre>{json.dumps(data, indent=2)}</pre>\ndeveloper: @Nullprotocol_X\npowered_by: NULL PROTOCOL'
+def log_to_channel(cmd: str, result: str, user_id: int, query: str, group_id: int):
+    channel_id = LOG_CHANNELS.get(cmd.upper())
+    if channel_id:
+        text = f"User ID: {user_id}\nGroup ID: {group_id}\nQuery: {query}\nResult:\n{result}"
+        log_shipper.submit(channel_id, text)
+
+def chunk_result(text: str, size: int) -> list:
+    chunks = []
+    current = ""
+    for line in text.splitlines(keepends=True):
+        if current and len(current) + len(line) > size:
+            chunks.append(current)
+            current = ""
+        while len(line) > size:
+            chunks.append(line[:size])
+            line = line[size:]
+        current += line
+    if current:
+        chunks.append(current)
+    return chunks
+
+async def send_result(message: Message, result: str, query: str):
     kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton("Copy", callback_data="copy_result")],
-        [InlineKeyboardButton("Search", switch_inline_query_current_chat=query)]
+        [InlineKeyboardButton(text="Copy", callback_data="copy_result")],
+        [InlineKeyboardButton(text="Search", switch_inline_query_current_chat=query[:256])]
     ])
-    await message.reply(html, parse_mode=ParseMode.HTML, reply_markup=kb)
+    chunks = chunk_result(result, MESSAGE_LIMIT - len(RESULT_FOOTER))
+    if len(chunks) > MAX_RESULT_CHUNKS:
+        document = BufferedInputFile(result.encode(), filename="result.json")
+        await message.reply_document(document, caption=RESULT_FOOTER.strip(), reply_markup=kb)
+        return
+    for chunk in chunks[:-1]:
+        await message.reply(f"<pre>{html.escape(chunk, quote=False)}</pre>", parse_mode=ParseMode.HTML)
+    await message.reply(f"<pre>{html.escape(chunks[-1], quote=False)}</pre>{RESULT_FOOTER}", parse_mode=ParseMode.HTML, reply_markup=kb)
 
 def create_command_handler(cmd: str):
     async def handler(message: Message):
@@ -215,18 +618,24 @@ def create_command_handler(cmd: str):
         if not await get_user(user_id):
             await add_user(user_id, now, now, 0)
         else:
-            await update_user(user_id, now, 1)
+            queue_user_update(user_id, now, 1)
         config = COMMANDS[cmd]
         url = config["url"].format(query=query)
-        data = await fetch_api(url)
+        data = await upstream_flights.do(
+            (cmd, " ".join(query.split())), lambda: fetch_api(url, timeout=config.get("timeout", HTTP_TIMEOUT))
+        )
         if "error" in data:
             await message.reply("Error fetching data. Please try again later.")
             return
-        cleaned = clean_branding(data, config["extra_clean"])
-        await send_result(message, cleaned, query)
-        await log_to_channel(config["log"], data, user_id, query, message.chat.id)
-        await add_lookup(user_id, cmd, query, json.dumps(data), now)
-        await increment_daily_stat(now[:10], cmd)
+        with tracing.span("clean_branding"):
+            cleaned = clean_branding(data, config["extra_clean"])
+        result = json.dumps(cleaned, indent=2)
+        with tracing.span("send_result"):
+            await send_result(message, result, query)
+        log_to_channel(config["log"], result, user_id, query, message.chat.id)
+        queue_lookup(user_id, cmd, query, json.dumps(data), now)
+        queue_daily_stat(now[:10], cmd)
+    handler.__name__ = cmd
     return handler
 
 for cmd in COMMANDS:
@@ -235,8 +644,10 @@ for cmd in COMMANDS:
 @router.callback_query(lambda c: c.data == "retry_join")
 async def retry_join(callback: CallbackQuery):
     user_id = callback.from_user.id
-    joined1 = await check_member(CHANNEL1_ID, user_id)
-    joined2 = await check_member(CHANNEL2_ID, user_id)
+    member_cache.invalidate(user_id, CHANNEL1_ID, CHANNEL2_ID)
+    joined1, joined2 = await asyncio.gather(
+        check_member(CHANNEL1_ID, user_id), check_member(CHANNEL2_ID, user_id)
+    )
     if joined1 and joined2:
         await callback.message.edit_text("Joined successfully. You can now use the bot.")
     else:
@@ -255,18 +666,9 @@ async def broadcast_start(message: Message, state: FSMContext):
 @router.message(BroadcastForm.message)
 @admin_required
 async def broadcast_process(message: Message, state: FSMContext):
-    users = await get_all_users()
-    success = 0
-    for user_id in users:
-        try:
-            await bot.copy_message(user_id, message.chat.id, message.message_id)
-            success += 1
-            await asyncio.sleep(0.1)
-        except TelegramRetryAfter as e:
-            await asyncio.sleep(e.retry_after)
-        except Exception:
-            pass
-    await message.reply(f"Broadcast sent to {success} users.")
+    users = await get_broadcast_targets()
+    status = await message.reply(f"Broadcast to {len(users)} users queued.")
+    await broadcaster.submit("broadcast", message.chat.id, message.message_id, users, status.chat.id, status.message_id)
     await state.clear()
 
 @router.message(Command("dm"))
@@ -303,19 +705,32 @@ async def bulkdm_process(message: Message, state: FSMContext):
     data = await state.get_data()
     ids_str = data["ids"]
     user_ids = [int(uid.strip()) for uid in ids_str.split(",") if uid.strip().isdigit()]
-    success = 0
-    for user_id in user_ids:
-        try:
-            await bot.copy_message(user_id, message.chat.id, message.message_id)
-            success += 1
-            await asyncio.sleep(0.1)
-        except TelegramRetryAfter as e:
-            await asyncio.sleep(e.retry_after)
-        except Exception:
-            pass
-    await message.reply(f"Bulk DM sent to {success} users.")
+    status = await message.reply(f"Bulk DM to {len(user_ids)} users queued.")
+    await broadcaster.submit("bulkdm", message.chat.id, message.message_id, user_ids, status.chat.id, status.message_id)
     await state.clear()
 
+@router.message(Command("jobs"))
+@admin_required
+async def jobs(message: Message):
+    text = "\n\n".join(await broadcaster.progress())
+    await message.reply(text or "No broadcast jobs.")
+
+@router.message(Command("canceljob"))
+@admin_required
+async def canceljob(message: Message):
+    args = message.text.split(maxsplit=1)
+    if len(args) < 2:
+        await message.reply("Usage: /canceljob <job_id>")
+        return
+    try:
+        job_id = int(args[1])
+        if await broadcaster.cancel(job_id):
+            await message.reply("Job cancelled.")
+        else:
+            await message.reply("No running job with that ID.")
+    except Exception:
+        await message.reply("Failed.")
+
 @router.message(Command("ban"))
 @admin_required
 async def ban(message: Message):
@@ -362,16 +777,11 @@ async def deleteuser(message: Message):
 @admin_required
 async def searchuser(message: Message):
     args = message.text.split(maxsplit=1)
-    if len(args) < 2:
-        await message.reply("Usage: /searchuser <query>")
+    if len(args) < 2 or parse_search(args[1]) is None:
+        await message.reply(SEARCH_USAGE)
         return
-    query = args[1]
-    results = await search_user(query)
-    if results:
-        text = "\n".join([f"ID: {r[0]}, First: {r[1]}, Last: {r[2]}, Lookups: {r[3]}" for r in results])
-        await message.reply(text)
-    else:
-        await message.reply("No results.")
+    text, kb = await load_page("search", args[1].strip(), "")
+    await message.reply(text, reply_markup=kb)
 
 @router.message(Command("users"))
 @admin_required
@@ -394,10 +804,8 @@ async def userlookups(message: Message):
         await message.reply("Usage: /userlookups <user_id>")
         return
     try:
-        user_id = int(args[1])
-        lookups = await get_user_lookups(user_id)
-        text = "\n".join([f"{l[1]}: {l[2]} at {l[4]}" for l in lookups])
-        await message.reply(text or "No lookups.")
+        text, kb = await load_page("lookups", str(int(args[1])), "")
+        await message.reply(text, reply_markup=kb)
     except Exception:
         await message.reply("Failed.")
 
@@ -411,9 +819,72 @@ async def leaderboard(message: Message):
 @router.message(Command("inactiveusers"))
 @admin_required
 async def inactiveusers(message: Message):
-    inactives = await get_inactive_users()
-    text = "\n".join([f"ID: {i[0]}, Last: {i[1]}" for i in inactives])
-    await message.reply(text or "No inactive users.")
+    text, kb = await load_page("inactive", "", "")
+    await message.reply(text, reply_markup=kb)
+
+async def load_page(kind: str, arg: str, cursor: str):
+    if kind == "inactive":
+        after = None
+        if cursor:
+            last_seen, user_id = cursor.rsplit("/", 1)
+            after = (last_seen, int(user_id))
+        rows = await get_inactive_users(after, PAGE_SIZE + 1)
+        lines = [f"ID: {i[0]}, Last: {i[1]}" for i in rows[:PAGE_SIZE]]
+        empty = "No inactive users."
+        next_cursor = f"{rows[PAGE_SIZE - 1][1]}/{rows[PAGE_SIZE - 1][0]}" if len(rows) > PAGE_SIZE else ""
+    elif kind == "lookups":
+        before = None
+        if cursor:
+            timestamp, lookup_id = cursor.rsplit("/", 1)
+            before = (timestamp, int(lookup_id))
+        rows = await get_user_lookups(int(arg), before, PAGE_SIZE + 1)
+        lines = [f"{l[2]}: {(l[3] or '')[:64]} at {l[5]}" for l in rows[:PAGE_SIZE]]
+        empty = "No lookups."
+        next_cursor = f"{rows[PAGE_SIZE - 1][5]}/{rows[PAGE_SIZE - 1][0]}" if len(rows) > PAGE_SIZE else ""
+    else:
+        mode = parse_search(arg)[0]
+        column = SEARCH_SORT_COLUMNS.get(mode)
+        after = None
+        if cursor and column:
+            value, user_id = cursor.rsplit("/", 1)
+            after = (value, int(user_id))
+        elif cursor:
+            after = int(cursor)
+        rows = await search_user(arg, after, PAGE_SIZE + 1)
+        lines = [f"ID: {r[0]}, First: {r[1]}, Last: {r[2]}, Lookups: {r[3]}" for r in rows[:PAGE_SIZE]]
+        empty = "No results."
+        next_cursor = ""
+        if len(rows) > PAGE_SIZE:
+            last = rows[PAGE_SIZE - 1]
+            next_cursor = f"{last[column]}/{last[0]}" if column else str(last[0])
+    if not lines:
+        return empty, None
+    buttons = []
+    if cursor:
+        buttons.append(InlineKeyboardButton(text="First", callback_data=f"pg|{kind}|{arg}|"))
+    if len(rows) > PAGE_SIZE:
+        data = f"pg|{kind}|{arg}|{next_cursor}"
+        if len(data.encode()) <= 64:
+            buttons.append(InlineKeyboardButton(text="Next", callback_data=data))
+        else:
+            lines.append("More results available; use a shorter query.")
+    kb = InlineKeyboardMarkup(inline_keyboard=[buttons]) if buttons else None
+    return "\n".join(lines), kb
+
+@router.callback_query(lambda c: c.data and c.data.startswith("pg|"))
+async def page_callback(callback: CallbackQuery):
+    user_id = callback.from_user.id
+    if user_id != OWNER_ID and not await is_admin(user_id):
+        await callback.answer("You are not authorized.", show_alert=True)
+        return
+    _, kind, rest = callback.data.split("|", 2)
+    arg, cursor = rest.rsplit("|", 1)
+    text, kb = await load_page(kind, arg, cursor)
+    try:
+        await callback.message.edit_text(text, reply_markup=kb)
+    except Exception:
+        pass
+    await callback.answer()
 
 @router.message(Command("stats"))
 @admin_required
@@ -422,6 +893,73 @@ async def stats(message: Message):
     text = f"Users: {s['users']}\nLookups: {s['lookups']}"
     await message.reply(text)
 
+@router.message(Command("httpstats"))
+@admin_required
+async def httpstats(message: Message):
+    s = http_pool_stats()
+    lines = [f"Connections: {s['in_use']} in use, {s['idle']} idle (limit {s['limit']}, per host {s['limit_per_host']})"]
+    for host, h in sorted(s["hosts"].items()):
+        lines.append(f"{host}: {h['in_use']} in use, {h['idle']} idle, {h['waiting']} waiting")
+    lines.append(
+        f"Upstream requests: {upstream_flights.started} sent, {upstream_flights.coalesced} coalesced, "
+        f"{len(upstream_flights.calls)} in flight"
+    )
+    await message.reply("\n".join(lines))
+
+@router.message(Command("breakers"))
+@admin_required
+async def breakerstats(message: Message):
+    lines = []
+    for host, b in sorted(breakers.items()):
+        line = f"{host}: {b.state}, failures {b.failures}, rejected {b.rejected}"
+        if b.state == "open":
+            line += f", retry in {b.retry_in():.0f}s"
+        lines.append(line)
+    await message.reply("\n".join(lines) or "No upstream calls yet.")
+
+@router.message(Command("queuestats"))
+@admin_required
+async def queuestats(message: Message):
+    s = update_queue.stats()
+    text = (
+        f"Queue: {s['depth']}/{s['capacity']}, workers: {s['workers']}\n"
+        f"Accepted: {s['accepted']}, duplicates: {s['duplicates']}, rejected: {s['rejected']}\n"
+        f"Processed: {s['processed']}, failed: {s['failed']}\n"
+        f"Wait avg/max: {s['wait_avg'] * 1000:.0f}/{s['wait_max'] * 1000:.0f} ms\n"
+        f"Handle avg/max: {s['handle_avg'] * 1000:.0f}/{s['handle_max'] * 1000:.0f} ms"
+    )
+    s = log_shipper.stats()
+    text += (
+        f"\nLog channels: {s['pending']} pending in {s['channels']} channels\n"
+        f"Shipped: {s['shipped']} in {s['messages']} messages and {s['documents']} documents\n"
+        f"Dropped: {s['dropped']}, failed: {s['failed']}"
+    )
+    await message.reply(text)
+
+@router.message(Command("traces"))
+@owner_required
+async def traces(message: Message):
+    args = message.text.split()
+    if len(args) == 3 and args[1] == "rate":
+        try:
+            rate = float(args[2])
+        except ValueError:
+            rate = -1
+        if not 0 <= rate <= 1:
+            await message.reply("Usage: /traces rate <0..1>")
+            return
+        tracing.sample_rate = rate
+        await message.reply(f"Trace sample rate set to {rate}.")
+        return
+    count = int(args[1]) if len(args) == 2 and args[1].isdigit() else 3
+    header = (
+        f"Sample rate: {tracing.sample_rate}, slow threshold: {tracing.slow_ms:.0f} ms\n"
+        f"Sampled: {tracing.sampled}, slow: {tracing.slow}"
+    )
+    slow = list(tracing.recent)[-count:] if count else []
+    text = "\n\n".join([header] + [t.format() for t in reversed(slow)])
+    await message.reply(text[:4096])
+
 @router.message(Command("dailystats"))
 @admin_required
 async def dailystats(message: Message):
@@ -436,6 +974,63 @@ async def lookupstats(message: Message):
     text = "\n".join([f"{l[0]}: {l[1]}" for l in ls])
     await message.reply(text or "No data.")
 
+@router.message(Command("rebuildstats"))
+@admin_required
+async def rebuildstats(message: Message):
+    try:
+        await rebuild_counters()
+        s = await get_total_stats()
+        await message.reply(f"Stats rebuilt.\nUsers: {s['users']}\nLookups: {s['lookups']}")
+    except Exception:
+        await message.reply("Failed.")
+
+@router.message(Command("retention"))
+@admin_required
+async def retention(message: Message):
+    args = message.text.split(maxsplit=1)
+    r = last_retention
+    if len(args) > 1 and args[1].strip() == "run":
+        r = await run_retention()
+    if r is None:
+        await message.reply(f"Retention has not run yet (policy: {retention_policy()}). Use /retention run")
+        return
+    text = (
+        f"Last run: {r['finished_at']} ({r['duration']:.1f}s)\n"
+        f"Expired: {r['expired']}, over cap: {r['capped']}\n"
+        f"Reclaimed: {r['reclaimed'] / 1048576:.1f} MB, database: {r['size'] / 1048576:.1f} MB\n"
+        f"Policy: {retention_policy()}"
+    )
+    if not r["incremental"]:
+        text += "\nFreed pages are reused but the file does not shrink. See /vacuum."
+    await message.reply(text)
+
+@router.message(Command("vacuum"))
+@owner_required
+async def vacuum(message: Message):
+    args = message.text.split(maxsplit=1)
+    size = os.path.getsize(DB_PATH)
+    if await auto_vacuum_mode() == 2:
+        await message.reply(f"Incremental vacuum is enabled. Database: {size / 1048576:.1f} MB")
+        return
+    if len(args) < 2 or args[1].strip() != "incremental":
+        await message.reply(
+            f"Incremental vacuum is off. Database: {size / 1048576:.1f} MB\n"
+            "/vacuum incremental rewrites the whole file once so retention can shrink it. "
+            "All writes wait until it finishes and it needs about twice the database size in free disk."
+        )
+        return
+    free = shutil.disk_usage(os.path.dirname(os.path.abspath(DB_PATH))).free
+    if free < 2 * size:
+        await message.reply(f"Not enough free disk: {free / 1048576:.1f} MB free, {2 * size / 1048576:.1f} MB needed.")
+        return
+    await message.reply("Rewriting the database. Writes are paused until this finishes.")
+    started = time.monotonic()
+    await enable_incremental_vacuum()
+    await message.reply(
+        f"Incremental vacuum enabled in {time.monotonic() - started:.0f}s. "
+        f"Database: {os.path.getsize(DB_PATH) / 1048576:.1f} MB"
+    )
+
 @router.message(Command("addadmin"))
 @owner_required
 async def addadmin(message: Message):
@@ -479,28 +1074,151 @@ async def settings(message: Message):
 @router.message(Command("fulldbbackup"))
 @owner_required
 async def fulldbbackup(message: Message):
-    await bot.send_document(message.chat.id, FSInputFile("bot.db"))
+    args = message.text.split()[1:]
+    exclude = ("lookups.result",) if "noresults" in args else ()
+    await message.reply("Creating snapshot...")
+    with tempfile.TemporaryDirectory() as directory:
+        try:
+            parts = await create_snapshot(DB_PATH, directory, exclude)
+        except Exception:
+            logging.exception("Snapshot failed")
+            await message.reply("Backup failed.")
+            return
+        for number, path in enumerate(parts, start=1):
+            caption = f"Part {number}/{len(parts)}, join with cat before gunzip" if len(parts) > 1 else None
+            await bot.send_document(message.chat.id, FSInputFile(path), caption=caption)
+
+last_retention = None
+retention_task = None
+backup_task = None
+
+async def run_retention():
+    global last_retention
+    result = await prune_lookups(LOOKUP_MAX_AGE_DAYS, LOOKUP_MAX_ROWS)
+    result["finished_at"] = datetime.utcnow().isoformat(timespec="seconds")
+    last_retention = result
+    logging.info(
+        "Retention removed %s expired and %s capped lookups, reclaimed %s bytes",
+        result["expired"], result["capped"], result["reclaimed"]
+    )
+    return result
+
+def retention_policy() -> str:
+    if not LOOKUP_MAX_AGE_DAYS and not LOOKUP_MAX_ROWS:
+        return "disabled"
+    limits = []
+    if LOOKUP_MAX_AGE_DAYS:
+        limits.append(f"{LOOKUP_MAX_AGE_DAYS} days")
+    if LOOKUP_MAX_ROWS:
+        limits.append(f"{LOOKUP_MAX_ROWS} rows")
+    return ", ".join(limits)
+
+async def retention_loop():
+    if retention_policy() == "disabled":
+        logging.info("Lookup retention is disabled; set LOOKUP_MAX_AGE_DAYS or LOOKUP_MAX_ROWS to enable it")
+        return
+    logging.info("Lookup retention will keep lookups within %s, checking every %ss", retention_policy(), RETENTION_INTERVAL)
+    while True:
+        try:
+            await run_retention()
+        except Exception:
+            logging.exception("Lookup retention failed")
+        await asyncio.sleep(RETENTION_INTERVAL)
+
+async def backup_loop():
+    interval = BACKUP_INTERVAL_HOURS * 3600
+    while True:
+        age = snapshot_age(BACKUP_DIR)
+        if age is not None and age < interval:
+            await asyncio.sleep(interval - age)
+            continue
+        try:
+            parts = await create_snapshot(DB_PATH, BACKUP_DIR)
+            removed = await asyncio.to_thread(prune_snapshots, BACKUP_DIR, BACKUP_KEEP)
+            logging.info("Wrote snapshot %s, removed %s old files", parts[0], removed)
+        except Exception:
+            logging.exception("Scheduled backup failed")
+            await asyncio.sleep(interval)
 
 async def health(request):
     return web.Response(text="Bot running")
 
+async def metrics(request):
+    if METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {METRICS_TOKEN}":
+        return web.Response(status=401)
+    return web.Response(text=render_metrics(), content_type="text/plain")
+
+async def process_update(data: Dict):
+    with tracing.trace("update", id=data.get("update_id")):
+        await dp.feed_update(bot, types.Update(**data))
+
+update_queue = UpdateQueue(process_update, WEBHOOK_WORKERS, WEBHOOK_QUEUE_SIZE)
+Gauge("bot_webhook_queue_depth", "Updates waiting in the webhook queue", collect=lambda: [((), update_queue.depth())])
+Counter(
+    "bot_webhook_updates_total", "Webhook updates by outcome", ("outcome",),
+    collect=lambda: [((key,), update_queue.stats()[key]) for key in ("accepted", "duplicates", "rejected", "failed")]
+)
+Gauge(
+    "bot_rate_limit_buckets", "Active rate limiter buckets per scope", ("scope",),
+    collect=lambda: [(("user",), len(user_limiter.buckets)), (("chat",), len(chat_limiter.buckets))]
+)
+Counter(
+    "bot_upstream_requests_total", "Lookup upstream requests sent or coalesced onto one in flight", ("outcome",),
+    collect=lambda: [(("sent",), upstream_flights.started), (("coalesced",), upstream_flights.coalesced)]
+)
+Gauge("bot_log_channel_pending", "Log entries waiting to be shipped", collect=lambda: [((), log_shipper.pending())])
+Counter(
+    "bot_log_channel_entries_total", "Log channel entries by outcome", ("outcome",),
+    collect=lambda: [((key,), log_shipper.stats()[key]) for key in ("shipped", "dropped", "failed")]
+)
+
 async def handle_webhook(request):
-    update = types.Update(**await request.json())
-    await dp.process_update(update)
+    try:
+        data = await request.json()
+    except ValueError:
+        return web.Response(status=400)
+    if not await update_queue.submit(data):
+        return web.Response(status=503)
     return web.Response()
 
-async def on_startup(app):
+async def start_services(background: bool = True):
+    global retention_task, backup_task
+    tracing.configure(TRACE_SAMPLE_RATE, TRACE_SLOW_MS, TRACE_FILE)
     await init_db()
+    await storage.start()
+    await start_http_session()
+    update_queue.start()
     await add_admin(OWNER_ID)
     await add_admin(5987905091)
+    if background:
+        await broadcaster.resume()
+        retention_task = asyncio.create_task(retention_loop())
+        if BACKUP_DIR:
+            backup_task = asyncio.create_task(backup_loop())
+
+async def stop_services():
+    tasks = [task for task in (retention_task, backup_task) if task is not None]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    await update_queue.close()
+    await broadcaster.close()
+    await log_shipper.close()
+    await close_http_session()
+    await storage.close()
+    await close_db()
+
+async def on_startup(app):
+    await start_services()
     webhook = f"{WEBHOOK_URL}{WEBHOOK_PATH}"
     await bot.set_webhook(webhook)
 
 async def on_shutdown(app):
     await bot.delete_webhook()
+    await stop_services()
 
 app = web.Application()
-app.add_routes([web.get("/", health), web.post(WEBHOOK_PATH, handle_webhook)])
+app.add_routes([web.get("/", health), web.get("/metrics", metrics), web.post(WEBHOOK_PATH, handle_webhook)])
 app.on_startup.append(on_startup)
 app.on_shutdown.append(on_shutdown)
 
@@ -0,0 +1,106 @@
+# metrics.py
+import time
+from bisect import bisect_left
+from functools import wraps
+
+from tracing import span
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+REGISTRY = []
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _label_pairs(names, values) -> list:
+    return [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str, labels: tuple = (), collect=None):
+        self.name = name
+        self.description = description
+        self.labels = labels
+        self.collect = collect
+        self._values = {}
+        REGISTRY.append(self)
+
+    def samples(self):
+        if self.collect is not None:
+            self._values = dict(self.collect())
+        for key, value in self._values.items():
+            yield self.name, key, "", value
+
+    def lines(self, prefix: list = ()) -> list:
+        lines = []
+        for name, key, extra, value in self.samples():
+            pairs = list(prefix) + _label_pairs(self.labels, key) + ([extra] if extra else [])
+            lines.append(f"{name}{{{','.join(pairs)}}} {value}" if pairs else f"{name} {value}")
+        return lines
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, *labels):
+        self._values[labels] = value
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS):
+        super().__init__(name, description, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *labels):
+        series = self._values.get(labels)
+        if series is None:
+            series = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def samples(self):
+        for key, (counts, total) in self._values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield f"{self.name}_bucket", key, f'le="{bound}"', cumulative
+            cumulative += counts[-1]
+            yield f"{self.name}_bucket", key, 'le="+Inf"', cumulative
+            yield f"{self.name}_sum", key, "", total
+            yield f"{self.name}_count", key, "", cumulative
+
+def timed(histogram: Histogram, label: str = None):
+    def decorator(func):
+        name = label or func.__name__
+        @wraps(func)
+        async def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                with span(name):
+                    return await func(*args, **kwargs)
+            finally:
+                histogram.observe(time.perf_counter() - started, name)
+        return wrapper
+    return decorator
+
+def collect(labels: dict = None, metrics: list = None) -> list:
+    prefix = _label_pairs(labels or {}, (labels or {}).values())
+    return [
+        (metric.name, metric.kind, metric.description, metric.lines(prefix))
+        for metric in (REGISTRY if metrics is None else metrics)
+    ]
+
+def render(*collections) -> str:
+    families = {}
+    for collection in collections or (collect(),):
+        for name, kind, description, samples in collection:
+            lines = families.setdefault(name, [f"# HELP {name} {description}", f"# TYPE {name} {kind}"])
+            lines += samples
+    return "\n".join(line for lines in families.values() for line in lines) + "\n"
@@ -0,0 +1,60 @@
+# ratelimit.py
+import asyncio
+import time
+from collections import OrderedDict
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_take(self, cost: float = 1) -> bool:
+        self._refill()
+        if self.tokens >= cost:
+            self.tokens -= cost
+            return True
+        return False
+
+    def delay(self, cost: float = 1) -> float:
+        self._refill()
+        return max(0.0, (cost - self.tokens) / self.rate)
+
+    async def take(self, cost: float = 1):
+        while not self.try_take(cost):
+            await asyncio.sleep(self.delay(cost))
+
+class KeyedBuckets:
+    def __init__(self, rate: float, capacity: float, max_keys: int):
+        self.rate = rate
+        self.capacity = capacity
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._buckets)
+
+    def get(self, key) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(self.rate, self.capacity)
+        else:
+            self._buckets.move_to_end(key)
+        self._evict()
+        return bucket
+
+    def _evict(self):
+        while len(self._buckets) > self.max_keys:
+            self._buckets.popitem(last=False)
+        now = time.monotonic()
+        while len(self._buckets) > 1:
+            bucket = next(iter(self._buckets.values()))
+            if bucket.tokens + (now - bucket.updated) * self.rate < self.capacity:
+                break
+            self._buckets.popitem(last=False)
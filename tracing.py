@@ -0,0 +1,100 @@
+# tracing.py
+import json
+import logging
+import random
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from logging.handlers import RotatingFileHandler
+
+KEEP_SLOW_TRACES = 20
+
+sample_rate = 0.0
+slow_ms = 1000.0
+recent = deque(maxlen=KEEP_SLOW_TRACES)
+sampled = 0
+slow = 0
+
+_current = ContextVar("trace", default=None)
+_file_logger = logging.getLogger("tracing.slow")
+_file_logger.propagate = False
+
+class Trace:
+    def __init__(self, name: str, attrs: dict):
+        self.name = name
+        self.attrs = attrs
+        self.started_at = time.time()
+        self.started = time.perf_counter()
+        self.duration = 0.0
+        self.spans = []
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "attrs": self.attrs,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration * 1000, 2),
+            "spans": [
+                {"name": name, "depth": depth, "offset_ms": round(offset * 1000, 2), "duration_ms": round(duration * 1000, 2)}
+                for name, depth, offset, duration in sorted(self.spans, key=lambda s: s[2])
+            ],
+        }
+
+    def format(self) -> str:
+        header = [self.name] + [f"{key}={value}" for key, value in self.attrs.items()]
+        lines = [" ".join(header) + f" {self.duration * 1000:.0f}ms"]
+        for name, depth, offset, duration in sorted(self.spans, key=lambda s: s[2]):
+            lines.append(f"{'  ' * (depth + 1)}{name} {duration * 1000:.1f}ms @{offset * 1000:.0f}ms")
+        return "\n".join(lines)
+
+def configure(rate: float, threshold_ms: float, path: str = None, max_bytes: int = 5 * 1024 * 1024, backups: int = 3):
+    global sample_rate, slow_ms
+    sample_rate = rate
+    slow_ms = threshold_ms
+    for handler in _file_logger.handlers[:]:
+        _file_logger.removeHandler(handler)
+        handler.close()
+    if path:
+        _file_logger.addHandler(RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups, delay=True))
+        _file_logger.setLevel(logging.INFO)
+
+def annotate(**attrs):
+    current = _current.get()
+    if current is not None:
+        current[0].attrs.update(attrs)
+
+@contextmanager
+def trace(name: str, **attrs):
+    global sampled, slow
+    if not sample_rate or random.random() >= sample_rate:
+        yield None
+        return
+    current = Trace(name, attrs)
+    token = _current.set((current, 0))
+    sampled += 1
+    try:
+        yield current
+    finally:
+        _current.reset(token)
+        current.duration = time.perf_counter() - current.started
+        if current.duration * 1000 >= slow_ms:
+            slow += 1
+            recent.append(current)
+            if _file_logger.handlers:
+                _file_logger.info(json.dumps(current.to_dict()))
+
+@contextmanager
+def span(name: str):
+    parent = _current.get()
+    if parent is None:
+        yield
+        return
+    current, depth = parent
+    token = _current.set((current, depth + 1))
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _current.reset(token)
+        current.spans.append((name, depth, started - current.started, time.perf_counter() - started))
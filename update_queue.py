@@ -0,0 +1,150 @@
+# update_queue.py
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+
+UPDATE_FIELDS = (
+    "message", "edited_message", "callback_query", "inline_query", "chosen_inline_result",
+    "channel_post", "edited_channel_post", "my_chat_member", "chat_member", "chat_join_request",
+)
+
+logger = logging.getLogger(__name__)
+
+def shard_key(update: dict) -> int:
+    for field in UPDATE_FIELDS:
+        event = update.get(field)
+        if not event:
+            continue
+        user = event.get("from")
+        if user:
+            return user["id"]
+        chat = event.get("chat")
+        if chat:
+            return chat["id"]
+    return update.get("update_id", 0)
+
+class RecentIds:
+    def __init__(self, size: int):
+        self.size = size
+        self._ids = OrderedDict()
+
+    def add(self, update_id: int) -> bool:
+        if update_id in self._ids:
+            return False
+        self._ids[update_id] = None
+        if len(self._ids) > self.size:
+            self._ids.popitem(last=False)
+        return True
+
+    def discard(self, update_id: int):
+        self._ids.pop(update_id, None)
+
+class UpdateQueue:
+    def __init__(self, process, workers: int, maxsize: int, put_timeout: float = 1.0, dedup_size: int = 10000):
+        self.process = process
+        self.workers = workers
+        self.put_timeout = put_timeout
+        self.capacity = maxsize
+        self._queue = asyncio.Queue()
+        self._slots = asyncio.Semaphore(maxsize)
+        self._recent = RecentIds(dedup_size)
+        self._pending = {}
+        self._parked = 0
+        self._tasks = []
+        self.accepted = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.handle_total = 0.0
+        self.handle_max = 0.0
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def close(self, timeout: float = 10):
+        try:
+            await asyncio.wait_for(self._queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logger.warning("Dropping %s queued updates on shutdown", self._queue.qsize())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, update: dict) -> bool:
+        update_id = update.get("update_id")
+        if update_id is not None and not self._recent.add(update_id):
+            self.duplicates += 1
+            return True
+        try:
+            await asyncio.wait_for(self._slots.acquire(), self.put_timeout)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            if update_id is not None:
+                self._recent.discard(update_id)
+            return False
+        self._queue.put_nowait((time.monotonic(), update))
+        self.accepted += 1
+        return True
+
+    def depth(self) -> int:
+        return self._queue.qsize() + self._parked
+
+    def stats(self) -> dict:
+        processed = self.processed or 1
+        return {
+            "depth": self.depth(),
+            "capacity": self.capacity,
+            "workers": self.workers,
+            "accepted": self.accepted,
+            "duplicates": self.duplicates,
+            "rejected": self.rejected,
+            "processed": self.processed,
+            "failed": self.failed,
+            "wait_avg": self.wait_total / processed,
+            "wait_max": self.wait_max,
+            "handle_avg": self.handle_total / processed,
+            "handle_max": self.handle_max,
+        }
+
+    async def _worker(self):
+        while True:
+            item = await self._queue.get()
+            key = shard_key(item[1])
+            pending = self._pending.get(key)
+            if pending is not None:
+                pending.append(item)
+                self._parked += 1
+                continue
+            pending = self._pending[key] = deque()
+            try:
+                while item is not None:
+                    try:
+                        await self._handle(*item)
+                    finally:
+                        self._slots.release()
+                        self._queue.task_done()
+                    item = pending.popleft() if pending else None
+                    if item is not None:
+                        self._parked -= 1
+            finally:
+                del self._pending[key]
+
+    async def _handle(self, enqueued_at: float, update: dict):
+        started_at = time.monotonic()
+        wait = started_at - enqueued_at
+        self.wait_total += wait
+        self.wait_max = max(self.wait_max, wait)
+        try:
+            await self.process(update)
+        except Exception:
+            self.failed += 1
+            logger.exception("Failed to process update %s", update.get("update_id"))
+        elapsed = time.monotonic() - started_at
+        self.processed += 1
+        self.handle_total += elapsed
+        self.handle_max = max(self.handle_max, elapsed)
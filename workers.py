@@ -0,0 +1,313 @@
+# workers.py
+import asyncio
+import itertools
+import logging
+import multiprocessing
+import os
+import queue
+import signal
+import time
+
+from aiohttp import web
+
+import main
+from database import add_acl_listener, close_db, init_db, load_acl
+from metrics import Counter, Gauge, collect, render
+from ratelimit import KeyedBuckets
+from update_queue import RecentIds, shard_key
+
+WORKERS = int(os.getenv("WORKERS", os.cpu_count() or 1))
+METRICS_TIMEOUT = 2.0
+CALL_TIMEOUT = 30.0
+RESPAWN_INTERVAL = 5.0
+STOP_TIMEOUT = 15.0
+
+logger = logging.getLogger(__name__)
+
+def scale_limits(count: int):
+    main.chat_limiter.buckets = KeyedBuckets(
+        main.RATE_CHAT_PER_MINUTE / 60 / count, max(main.RATE_CHAT_BURST / count, 2), main.RATE_MAX_KEYS
+    )
+    main.log_shipper.interval = main.LOG_CHANNEL_INTERVAL * count
+
+class RemoteBroadcaster:
+    def __init__(self, index: int, events):
+        self.index = index
+        self.events = events
+        self.calls = itertools.count()
+        self.pending = {}
+
+    async def submit(self, *args) -> int:
+        return await self._call("submit", *args)
+
+    async def progress(self) -> list:
+        return await self._call("progress")
+
+    async def cancel(self, job_id: int) -> bool:
+        return await self._call("cancel", job_id)
+
+    async def close(self):
+        pass
+
+    async def _call(self, method: str, *args):
+        call_id = next(self.calls)
+        future = self.pending[call_id] = asyncio.get_running_loop().create_future()
+        self.events.put(("call", self.index, call_id, method, args))
+        try:
+            return await asyncio.wait_for(future, CALL_TIMEOUT)
+        finally:
+            self.pending.pop(call_id, None)
+
+    def resolve(self, call_id: int, result, error: str = None):
+        future = self.pending.get(call_id)
+        if future is None or future.done():
+            return
+        if error is not None:
+            future.set_exception(RuntimeError(error))
+        else:
+            future.set_result(result)
+
+async def answer_call(events, caller: int, call_id: int, method: str, args: tuple):
+    try:
+        result = await getattr(main.broadcaster, method)(*args)
+    except Exception as e:
+        logger.exception("Broadcast call %s from worker %s failed", method, caller)
+        events.put(("reply", caller, call_id, None, str(e)))
+    else:
+        events.put(("reply", caller, call_id, result, None))
+
+def run_worker(index: int, count: int, updates, control, events):
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(worker_main(index, count, updates, control, events))
+
+async def worker_main(index: int, count: int, updates, control, events):
+    loop = asyncio.get_running_loop()
+    scale_limits(count)
+    main.update_queue.put_timeout = None
+    add_acl_listener(lambda: events.put(("acl", index)))
+    if index:
+        main.broadcaster = RemoteBroadcaster(index, events)
+    calls = set()
+    await main.start_services(background=index == 0)
+    logger.info("Worker %s started", index)
+
+    async def feed():
+        while True:
+            update = await loop.run_in_executor(None, updates.get)
+            if update is None:
+                return
+            await main.update_queue.submit(update)
+
+    async def serve():
+        while True:
+            message = await loop.run_in_executor(None, control.get)
+            if message[0] == "stop":
+                return
+            if message[0] == "reload_acl":
+                await load_acl()
+            elif message[0] == "metrics":
+                events.put(("metrics", message[1], index, collect({"worker": index})))
+            elif message[0] == "call":
+                task = asyncio.create_task(answer_call(events, *message[1:]))
+                calls.add(task)
+                task.add_done_callback(calls.discard)
+            elif message[0] == "reply":
+                main.broadcaster.resolve(*message[1:])
+
+    feeder = asyncio.create_task(feed())
+    await serve()
+    await feeder
+    await main.stop_services()
+    await main.bot.session.close()
+    logger.info("Worker %s stopped", index)
+
+class Front:
+    def __init__(self, count: int):
+        self.context = multiprocessing.get_context("spawn")
+        self.count = count
+        self.updates = [self.context.Queue(main.WEBHOOK_QUEUE_SIZE) for _ in range(count)]
+        self.controls = [self.context.Queue() for _ in range(count)]
+        self.events = self.context.Queue()
+        self.processes = [self._process(index) for index in range(count)]
+        self.respawned_at = [0.0] * count
+        self.recent = RecentIds(10000)
+        self.requests = itertools.count()
+        self.pending = {}
+        self.accepted = 0
+        self.duplicates = 0
+        self.rejected = 0
+        self.unavailable = 0
+        self.acl_reloads = 0
+        self.restarts = 0
+        self._stopping = False
+        self._listener = None
+        self._watcher = None
+        self.metrics = [
+            Counter(
+                "bot_front_updates_total", "Webhook updates seen by the front process by outcome", ("outcome",),
+                collect=lambda: [
+                    ((key,), getattr(self, key)) for key in ("accepted", "duplicates", "rejected", "unavailable")
+                ]
+            ),
+            Gauge(
+                "bot_front_queue_depth", "Updates waiting for each worker", ("worker",),
+                collect=lambda: [((index,), q.qsize()) for index, q in enumerate(self.updates)]
+            ),
+            Gauge(
+                "bot_front_worker_up", "Whether each worker process is alive", ("worker",),
+                collect=lambda: [((index,), int(p.is_alive())) for index, p in enumerate(self.processes)]
+            ),
+            Counter(
+                "bot_front_worker_restarts_total", "Worker processes respawned after exiting",
+                collect=lambda: [((), self.restarts)]
+            ),
+            Counter(
+                "bot_front_acl_reloads_total", "ACL changes fanned out to workers",
+                collect=lambda: [((), self.acl_reloads)]
+            ),
+        ]
+
+    def _process(self, index: int):
+        return self.context.Process(
+            target=run_worker, args=(index, self.count, self.updates[index], self.controls[index], self.events),
+            name=f"worker-{index}"
+        )
+
+    def _alive(self, index: int) -> bool:
+        process = self.processes[index]
+        if process.is_alive():
+            return True
+        if not self._stopping and time.monotonic() - self.respawned_at[index] >= RESPAWN_INTERVAL:
+            self.respawned_at[index] = time.monotonic()
+            self.restarts += 1
+            stale, self.updates[index] = self.updates[index], self.context.Queue(main.WEBHOOK_QUEUE_SIZE)
+            self.controls[index] = self.context.Queue()
+            recovered = 0
+            try:
+                while True:
+                    self.updates[index].put_nowait(stale.get_nowait())
+                    recovered += 1
+            except (queue.Empty, queue.Full):
+                pass
+            logger.error(
+                "Worker %s exited with code %s, respawning with %s recovered updates",
+                index, process.exitcode, recovered
+            )
+            self.processes[index] = self._process(index)
+            self.processes[index].start()
+        return False
+
+    async def watch(self):
+        while True:
+            await asyncio.sleep(RESPAWN_INTERVAL)
+            for index in range(self.count):
+                self._alive(index)
+
+    async def handle_webhook(self, request):
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(status=400)
+        update_id = data.get("update_id")
+        if update_id is not None and not self.recent.add(update_id):
+            self.duplicates += 1
+            return web.Response()
+        index = shard_key(data) % self.count
+        if not self._alive(index):
+            self.unavailable += 1
+            if update_id is not None:
+                self.recent.discard(update_id)
+            return web.Response(status=503)
+        try:
+            self.updates[index].put_nowait(data)
+        except queue.Full:
+            self.rejected += 1
+            if update_id is not None:
+                self.recent.discard(update_id)
+            return web.Response(status=503)
+        self.accepted += 1
+        return web.Response()
+
+    async def handle_metrics(self, request):
+        if main.METRICS_TOKEN and request.headers.get("Authorization") != f"Bearer {main.METRICS_TOKEN}":
+            return web.Response(status=401)
+        request_id = next(self.requests)
+        replies = self.pending[request_id] = asyncio.Queue()
+        results = []
+        deadline = time.monotonic() + METRICS_TIMEOUT
+        alive = [index for index in range(self.count) if self.processes[index].is_alive()]
+        for index in alive:
+            self.controls[index].put(("metrics", request_id))
+        try:
+            while len(results) < len(alive):
+                results.append(await asyncio.wait_for(replies.get(), deadline - time.monotonic()))
+        except asyncio.TimeoutError:
+            logger.warning("Only %s of %s workers reported metrics", len(results), len(alive))
+        finally:
+            self.pending.pop(request_id, None)
+        return web.Response(text=render(*results, collect(metrics=self.metrics)), content_type="text/plain")
+
+    async def listen(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            event = await loop.run_in_executor(None, self.events.get)
+            if event is None:
+                return
+            if event[0] == "acl":
+                self.acl_reloads += 1
+                for index, control in enumerate(self.controls):
+                    if index != event[1]:
+                        control.put(("reload_acl",))
+            elif event[0] == "call":
+                if self._alive(0):
+                    self.controls[0].put(("call",) + event[1:])
+                else:
+                    self.controls[event[1]].put(("reply", event[2], None, "worker 0 is not running"))
+            elif event[0] == "reply":
+                self.controls[event[1]].put(("reply",) + event[2:])
+            elif event[0] == "metrics":
+                replies = self.pending.get(event[1])
+                if replies is not None:
+                    replies.put_nowait(event[3])
+
+    async def on_startup(self, app):
+        await init_db()
+        await close_db()
+        for process in self.processes:
+            process.start()
+        self._listener = asyncio.create_task(self.listen())
+        self._watcher = asyncio.create_task(self.watch())
+        await main.bot.set_webhook(f"{main.WEBHOOK_URL}{main.WEBHOOK_PATH}")
+
+    async def on_shutdown(self, app):
+        loop = asyncio.get_running_loop()
+        self._stopping = True
+        self._watcher.cancel()
+        await main.bot.delete_webhook()
+        await main.bot.session.close()
+        for index in range(self.count):
+            if not self.processes[index].is_alive():
+                continue
+            self.controls[index].put(("stop",))
+            await loop.run_in_executor(None, self.updates[index].put, None)
+        for process in self.processes:
+            await loop.run_in_executor(None, process.join, STOP_TIMEOUT)
+            if process.is_alive():
+                logger.warning("Terminating %s", process.name)
+                process.terminate()
+        self.events.put(None)
+        await self._listener
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.add_routes([
+            web.get("/", main.health),
+            web.get("/metrics", self.handle_metrics),
+            web.post(main.WEBHOOK_PATH, self.handle_webhook),
+        ])
+        app.on_startup.append(self.on_startup)
+        app.on_shutdown.append(self.on_shutdown)
+        return app
+
+if __name__ == "__main__":
+    web.run_app(Front(WORKERS).app(), port=main.PORT)